@@ -1,7 +1,87 @@
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 from autogluon.common.utils.utils import setup_outputdir
 from autogluon.core.utils.loaders import load_pkl
 from autogluon.core.utils.savers import save_pkl
 from autogluon.tabular import TabularDataset, TabularPredictor
+import numpy as np
+import pandas as pd
+
+from distilled_predictor import DISTILLED_FILE, DistilledPredictor, fit_ridge
+
+
+class PredictorPool():
+    """ Keeps loaded TabularPredictors in memory so each one is read from disk once.
+        Predictors are keyed by their path and evicted least recently used first once `max_bytes` is exceeded.
+
+        Parameters
+        ----------
+        max_bytes : int, default = None
+            Memory cap for the pooled predictors, measured as the size of their directories on disk. No cap if None.
+            The predictor in use is never evicted, even if it alone is over the cap.
+        persist : bool, default = False
+            Whether to also keep the models inside each predictor loaded in memory (`TabularPredictor.persist`),
+            otherwise AutoGluon may still read individual models from disk while predicting.
+    """
+
+    def __init__(self, max_bytes=None, persist=False):
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self.predictors = OrderedDict()  # key = path, value = (TabularPredictor, size in bytes)
+        self.nbytes = 0
+        self.loads = 0
+
+    def __len__(self):
+        return len(self.predictors)
+
+    def get(self, path):
+        """ Returns the TabularPredictor saved at `path`, loading it on first use. """
+        entry = self.predictors.get(path)
+        if entry is not None:
+            self.predictors.move_to_end(path)
+            return entry[0]
+        self.loads += 1
+        predictor = TabularPredictor.load(path=path)
+        self.put(path, predictor)
+        return predictor
+
+    def put(self, path, predictor):
+        """ Adds a predictor, e.g. one that was just fit, and evicts the least recently used ones past the cap. """
+        if path in self.predictors:
+            self.nbytes -= self.predictors.pop(path)[1]
+        if self.persist:
+            if hasattr(predictor, 'persist'):
+                predictor.persist(models='all')
+            else:
+                predictor.persist_models(models='all')
+        size = directory_size(path)
+        self.predictors[path] = (predictor, size)
+        self.nbytes += size
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.predictors) > 1:
+            _, (evicted, evicted_size) = self.predictors.popitem(last=False)
+            self.nbytes -= evicted_size
+            if self.persist:
+                if hasattr(evicted, 'unpersist'):
+                    evicted.unpersist()
+                else:
+                    evicted.unpersist_models()
+
+    def clear(self):
+        self.predictors.clear()
+        self.nbytes = 0
+
+
+def directory_size(path):
+    """ Total size in bytes of the files under `path`. """
+    return sum(os.path.getsize(os.path.join(directory, filename))
+               for directory, _, filenames in os.walk(path) for filename in filenames)
 
 
 class MultilabelPredictor():
@@ -30,6 +110,10 @@ class MultilabelPredictor():
         kwargs :
             Arguments passed into the initialization of each TabularPredictor.
 
+        Saved TabularPredictors are loaded once into a PredictorPool, on first use, and reused by `predict`,
+        `predict_proba`, `evaluate` and `feature_imp`. `predict(data, labels=[...])` only loads the ones it needs.
+        Load everything up front with `preload()`, and cap or persist the pool via
+        `MultilabelPredictor.load(path, max_bytes=..., persist=True)` or `set_pool()`.
     """
 
     multi_predictor_file = 'multilabel_predictor.pkl'
@@ -63,13 +147,25 @@ class MultilabelPredictor():
             self.predictors[label] = TabularPredictor(label=label, problem_type=problem_type, eval_metric=eval_metric,
                                                       path=path_i, **kwargs)
 
-    def fit(self, train_data, tuning_data=None, **kwargs):
+    def fit(self, train_data, tuning_data=None, workers=1, num_cpus=None, memory_limit=None, **kwargs):
         """ Fits a separate TabularPredictor to predict each of the labels.
 
             Parameters
             ----------
             train_data, tuning_data : str or autogluon.tabular.TabularDataset or pd.DataFrame
                 See documentation for `TabularPredictor.fit()`.
+            workers : int, default = 1
+                Number of labels to fit at the same time, each in its own process. Every label is trained on the true
+                values of the labels before it, never on predictions, so the labels are independent whether or not
+                `consider_labels_correlation` is set and all of them can be fit at once.
+                With workers > 1, `time_limit` in kwargs is the budget of the whole fit rather than of each label.
+                The workers are spawned, so a script calling this must keep its top level code under
+                `if __name__ == '__main__':`.
+            num_cpus : int, default = None
+                CPUs to split between the workers, or to give each TabularPredictor with workers=1. All CPUs if None.
+            memory_limit : float, default = None
+                Memory in GB to split between the workers, or to give each TabularPredictor with workers=1.
+                AutoGluon's default if None.
             kwargs :
                 Arguments passed into the `fit()` call for each TabularPredictor.
         """
@@ -77,52 +173,92 @@ class MultilabelPredictor():
             train_data = TabularDataset(train_data)
         if tuning_data is not None and isinstance(tuning_data, str):
             tuning_data = TabularDataset(tuning_data)
-        train_data_og = train_data.copy()
-        if tuning_data is not None:
-            tuning_data_og = tuning_data.copy()
-        else:
-            tuning_data_og = None
         save_metrics = len(self.eval_metrics) == 0
+        if workers > 1:
+            self._fit_parallel(train_data, tuning_data, workers, num_cpus, memory_limit, save_metrics, **kwargs)
+            return
+        if num_cpus is not None:
+            kwargs.setdefault('num_cpus', num_cpus)
+        if memory_limit is not None:
+            kwargs.setdefault('memory_limit', memory_limit)
+        # the data passed in is never modified, only one label's subset of it exists at a time
         for i in range(len(self.labels)):
             label = self.labels[i]
             predictor = self.get_predictor(label)
-            if not self.consider_labels_correlation:
-                labels_to_drop = [l for l in self.labels if l != label]
-            else:
-                labels_to_drop = [self.labels[j] for j in range(i + 1, len(self.labels))]
-            train_data = train_data_og.drop(labels_to_drop, axis=1)
-            if tuning_data is not None:
-                tuning_data = tuning_data_og.drop(labels_to_drop, axis=1)
+            labels_to_drop = self._labels_to_drop(i)
+            label_train_data = train_data.drop(labels_to_drop, axis=1)
+            label_tuning_data = tuning_data.drop(labels_to_drop, axis=1) if tuning_data is not None else None
             print(f"Fitting TabularPredictor for label: {label} ...")
-            predictor.fit(train_data=train_data, tuning_data=tuning_data, **kwargs)
+            predictor.fit(train_data=label_train_data, tuning_data=label_tuning_data, **kwargs)
+            del label_train_data, label_tuning_data
             self.predictors[label] = predictor.path
+            self.pool.put(predictor.path, predictor)
             if save_metrics:
                 self.eval_metrics[label] = predictor.eval_metric
         self.save()
 
-    def predict(self, data, **kwargs):
+    def _labels_to_drop(self, i):
+        """ Labels that are not features of the ith label. """
+        if not self.consider_labels_correlation:
+            return [l for l in self.labels if l != self.labels[i]]
+        return self.labels[i + 1:]
+
+    def _fit_parallel(self, train_data, tuning_data, workers, num_cpus, memory_limit, save_metrics, **kwargs):
+        """ Fits the labels over a pool of `workers` processes, see `fit()`. """
+        workers = min(workers, len(self.labels))
+        num_cpus = num_cpus or os.cpu_count()
+        kwargs.setdefault('num_cpus', max(num_cpus // workers, 1))
+        if memory_limit is not None:
+            kwargs.setdefault('memory_limit', memory_limit / workers)
+        if kwargs.get('time_limit') is not None:
+            # labels run in waves of `workers`, each wave gets an even share of the budget
+            waves = math.ceil(len(self.labels) / workers)
+            kwargs['time_limit'] = kwargs['time_limit'] / waves
+        start = time.time()
+        # spawned rather than forked, AutoGluon's own worker processes and threads don't survive a fork
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {}
+            for i, label in enumerate(self.labels):
+                print(f"Fitting TabularPredictor for label: {label} ...")
+                # the workers drop the other labels themselves so the subsets never pile up here
+                futures[label] = executor.submit(_fit_predictor, self.get_predictor(label), train_data, tuning_data,
+                                                 self._labels_to_drop(i), kwargs)
+            for label, future in futures.items():
+                path, eval_metric = future.result()
+                self.predictors[label] = path
+                if save_metrics:
+                    self.eval_metrics[label] = eval_metric
+        print(f"Fit {len(self.labels)} labels over {workers} workers in {time.time() - start:.0f}s")
+        self.save()
+
+    def predict(self, data, labels=None, **kwargs):
         """ Returns DataFrame with label columns containing predictions for each label.
 
             Parameters
             ----------
             data : str or autogluon.tabular.TabularDataset or pd.DataFrame
                 Data to make predictions for. If label columns are present in this data, they will be ignored. See documentation for `TabularPredictor.predict()`.
+            labels : List[str], default = None
+                Labels to predict, all labels if None. Only the TabularPredictors these labels depend on are loaded and
+                run: with `consider_labels_correlation` the labels up to the last requested one, otherwise just these.
             kwargs :
                 Arguments passed into the predict() call for each TabularPredictor.
         """
-        return self._predict(data, as_proba=False, **kwargs)
+        return self._predict(data, as_proba=False, labels=labels, **kwargs)
 
-    def predict_proba(self, data, **kwargs):
+    def predict_proba(self, data, labels=None, **kwargs):
         """ Returns dict where each key is a label and the corresponding value is the `predict_proba()` output for just that label.
 
             Parameters
             ----------
             data : str or autogluon.tabular.TabularDataset or pd.DataFrame
                 Data to make predictions for. See documentation for `TabularPredictor.predict()` and `TabularPredictor.predict_proba()`.
+            labels : List[str], default = None
+                Labels to predict, all labels if None. See `predict()`.
             kwargs :
                 Arguments passed into the `predict_proba()` call for each TabularPredictor (also passed into a `predict()` call).
         """
-        return self._predict(data, as_proba=True, **kwargs)
+        return self._predict(data, as_proba=True, labels=labels, **kwargs)
 
     def evaluate(self, data, **kwargs):
         """ Returns dict where each key is a label and the corresponding value is the `evaluate()` output for just that label.
@@ -144,14 +280,144 @@ class MultilabelPredictor():
                 data[label] = predictor.predict(data, **kwargs)
         return eval_dict
 
-    def feature_imp(self, data, **kwargs):
+    def feature_imp(self, data, workers=1, subsample_size=None, ci_tolerance=None, cache=True, **kwargs):
+        """ Returns dict where each key is a label and the corresponding value is the permutation `feature_importance()`
+            output for just that label.
+
+            Parameters
+            ----------
+            data : str or autogluon.tabular.TabularDataset or pd.DataFrame
+                Data to permute the features of, must contain all labels as columns.
+            workers : int, default = 1
+                Number of labels to compute at the same time, each in its own spawned process, see `fit()`.
+            subsample_size : int, default = None
+                Rows sampled from `data`, AutoGluon's default if None. With `ci_tolerance` the first sample size
+                (1000 if None), doubled until the confidence intervals are narrow enough or it covers all of `data`.
+            ci_tolerance : float, default = None
+                Stop growing the sample once the half width of every feature's confidence interval is at most this
+                fraction of the largest importance. Needs `num_shuffle_sets` > 1 for the intervals to exist.
+            cache : bool, default = True
+                Whether to reuse results saved in `feature_importance/` under this predictor's directory. They are
+                keyed by the label's model path and last save, a fingerprint of `data` and the arguments, so asking
+                again for an unchanged model and data loads nothing but the saved result.
+            kwargs :
+                Arguments passed into the `feature_importance()` call for each TabularPredictor.
+        """
         data = self._get_data(data)
+        settings = {'subsample_size': subsample_size, 'ci_tolerance': ci_tolerance, **kwargs}
+        fingerprint = _data_fingerprint(data) if cache else None
         eval_dict = {}
+        cache_files = {}
         for label in self.labels:
-            predictor = self.get_predictor(label)
-            eval_dict[label] = predictor.feature_importance(data, **kwargs)
-            print(f"Evaluating feature importance for label: {label} ...")
-        return eval_dict
+            if cache:
+                cache_files[label] = self._importance_cache_file(label, fingerprint, settings)
+                if os.path.exists(cache_files[label]):
+                    eval_dict[label] = pd.read_pickle(cache_files[label])
+        labels = [label for label in self.labels if label not in eval_dict]
+
+        def done(label, importance):
+            eval_dict[label] = importance
+            if cache:
+                os.makedirs(os.path.dirname(cache_files[label]), exist_ok=True)
+                importance.to_pickle(cache_files[label] + '.tmp')
+                os.replace(cache_files[label] + '.tmp', cache_files[label])
+
+        if workers > 1 and len(labels) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(labels)),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                # the workers load their predictor themselves rather than receiving the loaded models
+                futures = {label: executor.submit(_feature_importance, self._predictor_path(label), data,
+                                                  subsample_size, ci_tolerance, kwargs)
+                           for label in labels}
+                for label, future in futures.items():
+                    print(f"Evaluating feature importance for label: {label} ...")
+                    done(label, future.result())
+        else:
+            for label in labels:
+                print(f"Evaluating feature importance for label: {label} ...")
+                done(label, _feature_importance(self.get_predictor(label), data, subsample_size, ci_tolerance, kwargs))
+        return {label: eval_dict[label] for label in self.labels}
+
+    def _predictor_path(self, label):
+        predictor = self.predictors[label]
+        return predictor if isinstance(predictor, str) else predictor.path
+
+    def _importance_cache_file(self, label, data_fingerprint, settings):
+        """ File the feature importance of `label` on data with `data_fingerprint` and `settings` is cached in. """
+        path = os.path.abspath(self._predictor_path(label))
+        # refitting rewrites the predictor's files, which invalidates the results of the old models
+        saved = max((entry.stat().st_mtime_ns for entry in os.scandir(path) if entry.is_file()), default=0) \
+            if os.path.isdir(path) else 0
+        key = json.dumps([path, saved, data_fingerprint, settings], sort_keys=True, default=str)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.path, 'feature_importance', f'{label}_{digest}.pkl')
+
+    def distill(self, train_data, test_data, path=None, alpha=1.0, tolerance=0.1):
+        """ Distills each label's TabularPredictor into a linear model and saves them as a `DistilledPredictor`,
+            which loads and predicts without AutoGluon. Returns the held out comparison of both, per label.
+
+            Parameters
+            ----------
+            train_data : str or autogluon.tabular.TabularDataset or pd.DataFrame
+                Data the linear models are fit on, to the predictions of the TabularPredictors rather than the labels.
+                Every label must be a column, the labels before a label are its features as in `fit()`.
+            test_data : str or autogluon.tabular.TabularDataset or pd.DataFrame
+                Held out data with every label as a column. Both predictors are run on it like `predict()`, each label
+                from the predictions of the labels before it.
+            path : str, default = None
+                File the distilled models are saved to, `distilled.npz` inside this predictor's directory if None.
+            alpha : float, default = 1.0
+                L2 penalty of the ridge regressions, on standardized features.
+            tolerance : float, default = 0.1
+                How much higher the held out RMSE of a distilled label may be than that of its TabularPredictor, as a
+                fraction of it. Nothing is saved and a ValueError is raised if any label is further off.
+        """
+        train_data = self._get_data(train_data)
+        test_data = self._get_data(test_data)
+        models = {}
+        for i, label in enumerate(self.labels):
+            print(f"Distilling TabularPredictor for label: {label} ...")
+            label_data = train_data.drop(self._labels_to_drop(i) + [label], axis=1)
+            target = self.get_predictor(label).predict(label_data).to_numpy()
+            chained = self.labels[:i] if self.consider_labels_correlation else []
+            features = [column for column in label_data.select_dtypes('number').columns if column not in chained]
+            features += chained
+            models[label] = (features, *fit_ridge(label_data[features].to_numpy(), target, alpha))
+            del label_data
+        distilled = DistilledPredictor(self.labels, models, self.consider_labels_correlation)
+
+        start = time.perf_counter()
+        predictions = self.predict(test_data)
+        predictor_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        distilled_predictions = distilled.predict(test_data)
+        distilled_seconds = time.perf_counter() - start
+        row = test_data.iloc[[0]]
+        start = time.perf_counter()
+        for _ in range(100):
+            distilled.predict(row)
+        row_ms = (time.perf_counter() - start) * 10
+
+        def rmse(predicted, label):
+            errors = predicted.to_numpy(np.float64) - test_data[label].to_numpy(np.float64)
+            return float(np.sqrt(np.nanmean(errors ** 2)))
+
+        report = {'labels': {label: {'rmse': rmse(predictions[label], label),
+                                     'distilled_rmse': rmse(distilled_predictions[label], label)}
+                             for label in self.labels},
+                  'predictor_seconds': predictor_seconds,
+                  'distilled_seconds': distilled_seconds,
+                  'distilled_row_ms': row_ms}
+        failed = [label for label, scores in report['labels'].items()
+                  if scores['distilled_rmse'] > scores['rmse'] * (1 + tolerance)]
+        if failed:
+            raise ValueError(f"Distilled models of {failed} are more than {tolerance:.0%} worse than their "
+                             f"TabularPredictors on test_data: {report}")
+        distilled.report = report
+        path = path or os.path.join(self.path, DISTILLED_FILE)
+        distilled.save(path)
+        print(f"DistilledPredictor saved to disk. Load with: DistilledPredictor.load('{path}')")
+        return report
 
     def save(self):
         """ Save MultilabelPredictor to disk. """
@@ -161,37 +427,129 @@ class MultilabelPredictor():
         save_pkl.save(path=self.path + self.multi_predictor_file, object=self)
         print(f"MultilabelPredictor saved to disk. Load with: MultilabelPredictor.load('{self.path}')")
 
+    def __getstate__(self):
+        # the pool holds loaded predictors, which are saved on their own
+        state = self.__dict__.copy()
+        state.pop('_pool', None)
+        return state
+
     @classmethod
-    def load(cls, path):
-        """ Load MultilabelPredictor from disk `path` previously specified when creating this MultilabelPredictor. """
+    def load(cls, path, max_bytes=None, persist=False):
+        """ Load MultilabelPredictor from disk `path` previously specified when creating this MultilabelPredictor.
+
+            Parameters
+            ----------
+            path : str
+                Directory the MultilabelPredictor was saved to.
+            max_bytes, persist :
+                Settings of the PredictorPool the TabularPredictors are loaded into, see `PredictorPool`.
+
+            No TabularPredictor is read here, each one is loaded when it is first used, see `preload()`.
+        """
         path = os.path.expanduser(path)
         if path[-1] != os.path.sep:
             path = path + os.path.sep
-        return load_pkl.load(path=path + cls.multi_predictor_file)
+        multi_predictor = load_pkl.load(path=path + cls.multi_predictor_file)
+        multi_predictor.set_pool(max_bytes=max_bytes, persist=persist)
+        return multi_predictor
+
+    def set_pool(self, max_bytes=None, persist=False):
+        """ Replaces the PredictorPool, dropping the predictors loaded so far. See `PredictorPool` for the parameters. """
+        self._pool = PredictorPool(max_bytes=max_bytes, persist=persist)
+
+    @property
+    def pool(self):
+        if getattr(self, '_pool', None) is None:
+            self.set_pool()
+        return self._pool
+
+    def preload(self, labels=None):
+        """ Loads the TabularPredictors `labels` need to be predicted (all labels if None) into the pool so later calls
+            don't touch disk. Returns self.
+        """
+        for label in self._required_labels(labels):
+            self.get_predictor(label)
+        return self
+
+    def _required_labels(self, labels=None):
+        """ Labels that have to be predicted to predict `labels`, in prediction order. """
+        if labels is None:
+            return self.labels
+        unknown = [label for label in labels if label not in self.labels]
+        if unknown:
+            raise ValueError(f"Unknown labels {unknown}, this MultilabelPredictor predicts {self.labels}")
+        if self.consider_labels_correlation:
+            # each label is predicted from the predictions of the labels before it
+            return self.labels[:max(self.labels.index(label) for label in labels) + 1]
+        return [label for label in self.labels if label in labels]
 
     def get_predictor(self, label):
         """ Returns TabularPredictor which is used to predict this label. """
         predictor = self.predictors[label]
         if isinstance(predictor, str):
-            return TabularPredictor.load(path=predictor)
+            return self.pool.get(predictor)
         return predictor
 
     def _get_data(self, data):
         if isinstance(data, str):
             return TabularDataset(data)
-        return data.copy()
+        # shallow copy: the label columns set on it are new arrays (pandas >= 2 never writes them into the shared
+        # ones), so the caller's data is left untouched without copying it
+        return data.copy(deep=False)
 
-    def _predict(self, data, as_proba=False, **kwargs):
+    def _predict(self, data, as_proba=False, labels=None, **kwargs):
         data = self._get_data(data)
         if as_proba:
             predproba_dict = {}
-        for label in self.labels:
+        predictions = {}
+        requested = self.labels if labels is None else list(labels)
+        for label in self._required_labels(labels):
             print(f"Predicting with TabularPredictor for label: {label} ...")
             predictor = self.get_predictor(label)
-            if as_proba:
+            if as_proba and label in requested:
                 predproba_dict[label] = predictor.predict_proba(data, as_multiclass=True, **kwargs)
-            data[label] = predictor.predict(data, **kwargs)
+            predictions[label] = predictor.predict(data, **kwargs)
+            if self.consider_labels_correlation:
+                # later labels are predicted from this one
+                data[label] = predictions[label]
         if not as_proba:
-            return data[self.labels]
+            return pd.DataFrame({label: predictions[label] for label in requested}, index=data.index)
         else:
             return predproba_dict
+
+
+def _data_fingerprint(data):
+    """ Hash of the values, index, columns and dtypes of a DataFrame. """
+    digest = hashlib.sha1(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    digest.update(repr(list(zip(data.columns, map(str, data.dtypes)))).encode())
+    return digest.hexdigest()
+
+
+def _feature_importance(predictor, data, subsample_size, ci_tolerance, kwargs):
+    """ Permutation feature importance of a TabularPredictor or of the one saved at that path, see `feature_imp()`. """
+    if isinstance(predictor, str):
+        predictor = TabularPredictor.load(path=predictor)
+    if ci_tolerance is None:
+        if subsample_size is not None:
+            kwargs = {**kwargs, 'subsample_size': subsample_size}
+        return predictor.feature_importance(data, **kwargs)
+    subsample_size = subsample_size or 1000
+    while True:
+        importance = predictor.feature_importance(data, subsample_size=subsample_size, **kwargs)
+        # AutoGluon names the interval columns after the rounded confidence level, e.g. p99_high and p99_low, they are
+        # looked up rather than rebuilt from confidence_level
+        high = next(column for column in importance.columns if column.endswith('_high'))
+        low = next(column for column in importance.columns if column.endswith('_low'))
+        half_width = (importance[high] - importance[low]) / 2
+        if subsample_size >= len(data) or (half_width <= ci_tolerance * importance['importance'].abs().max()).all():
+            return importance
+        subsample_size *= 2
+
+
+def _fit_predictor(predictor, train_data, tuning_data, labels_to_drop, kwargs):
+    """ Fits one TabularPredictor in a worker process, it saves itself to its path. """
+    train_data = train_data.drop(labels_to_drop, axis=1)
+    if tuning_data is not None:
+        tuning_data = tuning_data.drop(labels_to_drop, axis=1)
+    predictor.fit(train_data=train_data, tuning_data=tuning_data, **kwargs)
+    return predictor.path, predictor.eval_metric
@@ -0,0 +1,234 @@
+"""
+walk-forward backtest of the MultilabelPredictor of a region
+
+the single 85/15 split of create_AG_model.py scores one stretch of seasons. the backtest steps through the history
+instead: each fold trains on the months before its test months and predicts them, then the window moves on by the
+refit cadence. the training window is either every month so far (expanding) or the last `train_months` (rolling).
+
+every fold writes backtest_{degree_days}/fold_NNN/predictions.pkl and metrics.json, metrics.json last, so a backtest
+that is run again skips the folds that finished and starts over the ones that didn't. independent folds are fit in
+parallel processes that share the CPUs and the time budget of the whole backtest:
+
+    python backtest.py gw_hdd --window rolling --train-months 36 --refit-months 3 --workers 4 --time-limit 36000
+
+or set backtest = True in create_AG_model.py.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from master_frame import read_master_df
+from process_raw_data import LABELS, feature_columns
+
+FOLDS_FILE = 'folds.json'
+METRICS_FILE = 'metrics.json'
+PREDICTIONS_FILE = 'predictions.pkl'
+
+
+def make_folds(index, train_months=24, refit_months=3, window='expanding'):
+    """
+    split the months of a master_df into walk-forward folds
+    :param index: DatetimeIndex of master_df
+    :param train_months: months of history before the first test month, and the length of a rolling window
+    :param refit_months: months each fold predicts before the model is refit on the data up to them
+    :param window: 'expanding' to train on every month before the test months, 'rolling' on the last train_months
+    :return: list of folds, dicts of fold number and train_start, test_start, test_end timestamps as iso strings. the
+        fold trains on train_start <= date < test_start and predicts test_start <= date < test_end
+    """
+    if window not in ('expanding', 'rolling'):
+        raise ValueError(f'window must be expanding or rolling, not {window}')
+    months = index.to_period('M').unique().sort_values()
+    folds = []
+    for first in range(train_months, len(months), refit_months):
+        last = min(first + refit_months, len(months)) - 1
+        train_first = first - train_months if window == 'rolling' else 0
+        folds.append({'fold': len(folds),
+                      'train_start': months[train_first].start_time.isoformat(),
+                      'test_start': months[first].start_time.isoformat(),
+                      'test_end': (months[last] + 1).start_time.isoformat()})
+    return folds
+
+
+def fold_directory(output_dir, fold):
+    return os.path.join(output_dir, f"fold_{fold['fold']:03d}")
+
+
+def is_done(output_dir, fold):
+    """ whether the fold has been backtested up to its test_end """
+    metrics_file = os.path.join(fold_directory(output_dir, fold), METRICS_FILE)
+    if not os.path.exists(metrics_file):
+        return False
+    with open(metrics_file) as f:
+        return json.load(f)['test_end'] == fold['test_end']
+
+
+def run_fold(degree_days, name, fold, labels, output_dir, fit_kwargs, keep_models=False):
+    """
+    fit a MultilabelPredictor on the training months of a fold and predict its test months
+    :param degree_days: region, e.g. gw_hdd
+    :param name: master_df file name without .pkl, see read_master_df
+    :param fold: fold from make_folds
+    :param labels: labels to predict
+    :param output_dir: directory of the backtest
+    :param fit_kwargs: arguments passed to MultilabelPredictor.fit
+    :param keep_models: whether to keep the fold's models on disk once its predictions are written
+    :return: metrics of the fold, also written to its metrics.json
+    """
+    # imported here so the parent process of a backtest never loads autogluon
+    from MultiLabelPredictor import MultilabelPredictor
+    start = time.time()
+    directory = fold_directory(output_dir, fold)
+    # the leftovers of a fold that didn't finish
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    # only the months of the fold are read from the monthly parquet files
+    master_df = read_master_df(degree_days, start=fold['train_start'], end=fold['test_end'], name=name)
+    train_data = master_df[master_df.index < fold['test_start']]
+    test_data = master_df[(master_df.index >= fold['test_start']) & (master_df.index < fold['test_end'])]
+    del master_df
+
+    predictor = MultilabelPredictor(labels=labels, path=os.path.join(directory, 'models'))
+    predictor.fit(train_data, **fit_kwargs)
+    predictions = predictor.predict(test_data.drop(columns=labels))
+
+    results = test_data[labels].join(predictions.add_suffix('_pred'))
+    results.to_pickle(os.path.join(directory, PREDICTIONS_FILE))
+    metrics = {**fold, 'train_rows': len(train_data), 'test_rows': len(test_data), 'labels': {}}
+    for label in labels:
+        errors = predictions[label].to_numpy(np.float64) - test_data[label].to_numpy(np.float64)
+        # the 06z and 18z rows of a four cycle master_df have no value for the last labels
+        errors = errors[~np.isnan(errors)]
+        metrics['labels'][label] = {'rmse': float(np.sqrt(np.mean(errors ** 2))) if len(errors) else None,
+                                    'mae': float(np.mean(np.abs(errors))) if len(errors) else None,
+                                    'bias': float(np.mean(errors)) if len(errors) else None}
+    if not keep_models:
+        shutil.rmtree(predictor.path, ignore_errors=True)
+    metrics['seconds'] = time.time() - start
+    # written last, a fold with metrics.json is done
+    with open(os.path.join(directory, METRICS_FILE + '.tmp'), 'w') as f:
+        json.dump(metrics, f, indent=1)
+    os.replace(os.path.join(directory, METRICS_FILE + '.tmp'), os.path.join(directory, METRICS_FILE))
+    return metrics
+
+
+def walk_forward(degree_days='gw_hdd', labels=None, window='expanding', train_months=24, refit_months=3,
+                 workers=1, num_cpus=None, memory_limit=None, time_limit=None, output_dir=None, name=None,
+                 keep_models=False, **fit_kwargs):
+    """
+    walk-forward backtest, resuming from the folds a previous run of the same backtest finished
+    :param degree_days: region, e.g. gw_hdd
+    :param labels: labels to predict, the label columns of master_df if not given
+    :param window: 'expanding' or 'rolling', see make_folds
+    :param train_months: see make_folds
+    :param refit_months: see make_folds
+    :param workers: number of folds fit at the same time, each in its own spawned process. a script calling this
+        must keep its top level code under `if __name__ == '__main__':`
+    :param num_cpus: CPUs shared by the workers, all CPUs if not given
+    :param memory_limit: memory in GB shared by the workers, AutoGluon's default if not given
+    :param time_limit: seconds for the folds left to run, split evenly between them and their labels
+    :param output_dir: directory of the backtest, backtest_{degree_days} if not given
+    :param name: master_df file name without .pkl, see read_master_df
+    :param keep_models: whether to keep the models of every fold on disk
+    :param fit_kwargs: arguments passed to MultilabelPredictor.fit, e.g. presets
+    :return: dataframe of the metrics of every fold and label, also written to summary.csv
+    :raises ValueError: if output_dir holds a backtest with other folds
+    """
+    labels = labels or [column for spec in LABELS for column in feature_columns(spec)]
+    output_dir = output_dir or f'backtest_{degree_days}'
+    # only the index is needed to lay out the folds
+    index = read_master_df(degree_days, columns=labels[:1], name=name).index
+    folds = make_folds(index, train_months, refit_months, window)
+    config = {'degree_days': degree_days, 'name': name, 'labels': labels, 'window': window,
+              'train_months': train_months, 'refit_months': refit_months, 'folds': folds}
+
+    os.makedirs(output_dir, exist_ok=True)
+    folds_file = os.path.join(output_dir, FOLDS_FILE)
+    if os.path.exists(folds_file):
+        with open(folds_file) as f:
+            previous = json.load(f)
+        # new months only add folds at the end or extend the last one, the other finished folds stay valid
+        n_folds = min(len(folds), len(previous['folds']))
+        starts = [[(fold['train_start'], fold['test_start']) for fold in config_folds[:n_folds]]
+                  for config_folds in (previous['folds'], folds)]
+        if {**previous, 'folds': starts[0]} != {**config, 'folds': starts[1]}:
+            raise ValueError(f'{output_dir} holds another backtest, see {folds_file}')
+    with open(folds_file, 'w') as f:
+        json.dump(config, f, indent=1)
+
+    todo = [fold for fold in folds if not is_done(output_dir, fold)]
+    print(f'{len(folds) - len(todo)} of {len(folds)} folds already done')
+    if todo:
+        workers = max(1, min(workers, len(todo)))
+        fit_kwargs.setdefault('num_cpus', max((num_cpus or os.cpu_count()) // workers, 1))
+        if memory_limit is not None:
+            fit_kwargs.setdefault('memory_limit', memory_limit / workers)
+        if time_limit is not None:
+            # folds run in waves of `workers`, each fold gets an even share of its wave and MultilabelPredictor.fit
+            # gives every label the time_limit it is passed
+            waves = math.ceil(len(todo) / workers)
+            fit_kwargs['time_limit'] = time_limit / waves / len(labels)
+        start = time.time()
+        if workers == 1:
+            for fold in todo:
+                run_fold(degree_days, name, fold, labels, output_dir, fit_kwargs, keep_models)
+                print(f"fold {fold['fold']} done, {time.time() - start:.0f}s")
+        else:
+            # spawned rather than forked, AutoGluon's own worker processes and threads don't survive a fork
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(run_fold, degree_days, name, fold, labels, output_dir, fit_kwargs,
+                                           keep_models)
+                           for fold in todo]
+                for future in futures:
+                    metrics = future.result()
+                    print(f"fold {metrics['fold']} done, {time.time() - start:.0f}s")
+    return summarize(output_dir)
+
+
+def summarize(output_dir):
+    """
+    collect the metrics of the finished folds of a backtest
+    :param output_dir: directory of the backtest
+    :return: dataframe with a row per fold and label, also written to summary.csv
+    """
+    rows = []
+    for directory in sorted(os.listdir(output_dir)):
+        metrics_file = os.path.join(output_dir, directory, METRICS_FILE)
+        if not directory.startswith('fold_') or not os.path.exists(metrics_file):
+            continue
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        for label, scores in metrics.pop('labels').items():
+            rows.append({**metrics, 'label': label, **scores})
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(output_dir, 'summary.csv'), index=False)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('degree_days', nargs='?', default='gw_hdd')
+    parser.add_argument('--window', choices=['expanding', 'rolling'], default='expanding')
+    parser.add_argument('--train-months', type=int, default=24)
+    parser.add_argument('--refit-months', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--num-cpus', type=int)
+    parser.add_argument('--memory-limit', type=float, help='GB shared by the workers')
+    parser.add_argument('--time-limit', type=float, help='seconds for the whole backtest')
+    parser.add_argument('--presets', default='medium_quality')
+    parser.add_argument('--output-dir')
+    parser.add_argument('--keep-models', action='store_true')
+    args = parser.parse_args()
+
+    summary = walk_forward(args.degree_days, window=args.window, train_months=args.train_months,
+                           refit_months=args.refit_months, workers=args.workers, num_cpus=args.num_cpus,
+                           memory_limit=args.memory_limit, time_limit=args.time_limit, output_dir=args.output_dir,
+                           keep_models=args.keep_models, presets=args.presets)
+    print(summary.groupby('label')[['rmse', 'mae', 'bias']].mean())
@@ -0,0 +1,51 @@
+"""
+benchmark of parse_forecast_file against pd.read_csv on the real RawData archive, run with:
+    python benchmark_ingest.py
+
+the stages of the build are benchmarked on synthetic archives by test_benchmark_ingest.py.
+"""
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from process_raw_data import parse_forecast_file
+
+
+def benchmark_parser(path='RawData', n_files=5000, seed=0):
+    """
+    time parse_forecast_file against pd.read_csv on a random sample of the real archive and check they agree
+    :param path: directory holding the RawData csv files
+    :param n_files: number of files to sample
+    :param seed: seed of the sample
+    :return: dict with the files per second of each reader
+    """
+    filenames = sorted(filename for filename in os.listdir(path) if filename.endswith('.csv'))
+    files = [os.path.join(path, filename) for filename in
+             random.Random(seed).sample(filenames, min(n_files, len(filenames)))]
+    files = [file for file in files if os.path.getsize(file) > 0]
+
+    start = time.perf_counter()
+    pandas_values = []
+    for file in files:
+        df = pd.read_csv(file)
+        pandas_values.append(df[df[df.columns[2]] >= 1]['Value'].to_numpy())
+    pandas_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed_values = [parse_forecast_file(file, forecast_only=True)[1] for file in files]
+    parser_time = time.perf_counter() - start
+
+    mismatches = sum(not np.array_equal(a.astype(np.float32), b) for a, b in zip(pandas_values, parsed_values))
+    return {'files': len(files),
+            'pd.read_csv files/s': len(files) / pandas_time,
+            'parse_forecast_file files/s': len(files) / parser_time,
+            'speedup': pandas_time / parser_time,
+            'mismatches': mismatches}
+
+
+if __name__ == '__main__':
+    for name, result in benchmark_parser().items():
+        print(f'{name}: {result:.1f}' if isinstance(result, float) else f'{name}: {result}')
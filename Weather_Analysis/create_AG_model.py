@@ -1,44 +1,67 @@
 import os.path
 
-import pandas as pd
 from autogluon.tabular import TabularDataset
 
 from MultiLabelPredictor import MultilabelPredictor
+from master_frame import read_master_df
 from process_raw_data import ProcessRawData
 
 degree_days = 'ew_cdd'
+# train on the last n months only, None for the whole history
+last_months = None
+# walk-forward backtest over the whole history instead of the single split, see backtest.py
+backtest = False
+backtest_window = 'expanding'  # or 'rolling'
+backtest_train_months = 24
+backtest_refit_months = 3
+backtest_workers = 1
+backtest_time_limit = None  # seconds for the whole backtest
 
-if not os.path.exists(f'master_df_{degree_days}.pkl'):
-    print(f'master_df_{degree_days}.pkl not found, creating it')
-    ProcessRawData(degree_days=degree_days)
-else:
-    print(f'master_df_{degree_days}.pkl found, loading it')
-
+labels = ['ecmwf-eps_9', 'ecmwf-eps_10', 'ecmwf-eps_11', 'ecmwf-eps_12', 'ecmwf-eps_13',
+          'ecmwf-eps_14']
 
-master_df = pd.read_pickle(f'master_df_{degree_days}.pkl')
+# the backtest workers are spawned and import this script, only the main process may run it
+if __name__ == '__main__':
+    if not os.path.exists(f'master_df_{degree_days}.pkl'):
+        print(f'master_df_{degree_days}.pkl not found, creating it')
+        ProcessRawData(degree_days=degree_days)
+    else:
+        print(f'master_df_{degree_days}.pkl found, loading it')
 
-train_len = 0.85
-train_data = TabularDataset(master_df[:int(len(master_df) * train_len)])
-test_data = TabularDataset(master_df[int(len(master_df) * train_len):])
+    if backtest:
+        from backtest import walk_forward
+        summary = walk_forward(degree_days, labels=labels, window=backtest_window,
+                               train_months=backtest_train_months, refit_months=backtest_refit_months,
+                               workers=backtest_workers, time_limit=backtest_time_limit, presets='best_quality')
+        print(summary.groupby('label')[['rmse', 'mae', 'bias']].mean())
+    else:
+        master_df = read_master_df(degree_days, last_months=last_months)
 
-labels = ['ecmwf-eps_9', 'ecmwf-eps_10', 'ecmwf-eps_11', 'ecmwf-eps_12', 'ecmwf-eps_13',
-          'ecmwf-eps_14']
+        train_len = 0.85
+        train_data = TabularDataset(master_df[:int(len(master_df) * train_len)])
+        test_data = TabularDataset(master_df[int(len(master_df) * train_len):])
 
+        save_path = f'models/{degree_days}'
 
-save_path = f'models/{degree_days}'
+        if not os.path.exists(save_path):
+            # Create the directory
+            os.makedirs(save_path)
 
-if not os.path.exists(save_path):
-    # Create the directory
-    os.makedirs(save_path)
+        multi_predictor = MultilabelPredictor(labels=labels, path=save_path)
+        multi_predictor.fit(train_data, presets='best_quality') #presets = ['best_quality', 'optimize_for_deployment']
 
-multi_predictor = MultilabelPredictor(labels=labels, path=save_path)
-multi_predictor.fit(train_data, presets='best_quality') #presets = ['best_quality', 'optimize_for_deployment']
+        # Predict on test data
+        test_data_nolab = test_data.drop(columns=labels)
+        test_data_nolab.head()
 
-# Predict on test data
-test_data_nolab = test_data.drop(columns=labels)
-test_data_nolab.head()
+        evaluations = multi_predictor.evaluate(test_data)
 
-evaluations = multi_predictor.evaluate(test_data)
+        print("evaluations")
+        print(evaluations)
 
-print("evaluations")
-print(evaluations)
+        # linear copy of the label models that loads without autogluon, see distilled_predictor.py
+        try:
+            distill_report = multi_predictor.distill(train_data, test_data)
+            print(distill_report)
+        except ValueError as e:
+            print(f'not distilled: {e}')
@@ -0,0 +1,119 @@
+"""
+compact linear copies of the MultilabelPredictor label models, loaded and run with numpy alone
+
+the best_quality stacked ensembles are slow to load and take tens of milliseconds per row. MultilabelPredictor.distill
+fits a ridge regression per label on the ensemble's own predictions, checks it against the held out split and saves
+every label in one npz file:
+
+    multi_predictor.distill(train_data, test_data)                    # models/gw_hdd/distilled.npz
+    predictor = DistilledPredictor.load('models/gw_hdd/distilled.npz')
+    predictions = predictor.predict(features)
+
+loading it doesn't import autogluon, and a row is predicted in well under a millisecond.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+DISTILLED_FILE = 'distilled.npz'
+
+
+def fit_ridge(X, y, alpha=1.0):
+    """
+    ridge regression on standardized features, folded back into coefficients of the raw features
+    :param X: 2d array of features, NaN are replaced by the column mean
+    :param y: 1d array of targets
+    :param alpha: L2 penalty on the standardized coefficients
+    :return: (coef, intercept, fill) where fill is the value NaN features are replaced with
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    fill = np.nan_to_num(np.nanmean(X, axis=0)) if len(X) else np.zeros(X.shape[1])
+    X = np.where(np.isnan(X), fill, X)
+    mean = X.mean(axis=0)
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1.0
+    Xs = (X - mean) / scale
+    y_mean = y.mean()
+    weights = np.linalg.solve(Xs.T @ Xs + alpha * np.eye(X.shape[1]), Xs.T @ (y - y_mean))
+    coef = weights / scale
+    return coef, y_mean - mean @ coef, fill
+
+
+class DistilledPredictor:
+    """ linear model per label, predicted in the order of `labels` like MultilabelPredictor.
+
+        :param labels: labels in the order they are predicted
+        :param models: dict of label to (features, coef, intercept, fill). with consider_labels_correlation the last
+            features of the ith label are the labels before it, taken from the predictions rather than the data
+        :param consider_labels_correlation: whether each label uses the predictions of the labels before it
+        :param report: held out comparison with the predictor it was distilled from, see MultilabelPredictor.distill
+    """
+
+    def __init__(self, labels, models, consider_labels_correlation=True, report=None):
+        self.labels = list(labels)
+        self.models = models
+        self.consider_labels_correlation = consider_labels_correlation
+        self.report = report or {}
+        self._column_positions = {}
+
+    def predict(self, data):
+        """
+        predict every label
+        :param data: dataframe of feature rows, label columns in it are ignored
+        :return: dataframe of the predicted labels, indexed like `data`
+        """
+        # a single conversion of the whole frame, selecting columns with pandas would cost more than the models
+        values = data.to_numpy(np.float64)
+        positions = self._positions(tuple(data.columns))
+        predictions = {}
+        for i, label in enumerate(self.labels):
+            features, coef, intercept, fill = self.models[label]
+            n_features = len(positions[label])
+            X = values[:, positions[label]]
+            X = np.where(np.isnan(X), fill[:n_features], X)
+            y = X @ coef[:n_features] + intercept
+            for chained, chained_coef in zip(features[n_features:], coef[n_features:]):
+                y += chained_coef * predictions[chained]
+            predictions[label] = y
+        return pd.DataFrame(predictions, index=data.index)
+
+    def _positions(self, columns):
+        """ positions in `columns` of the features each label takes from the data """
+        positions = self._column_positions.get(columns)
+        if positions is None:
+            index = pd.Index(columns)
+            positions = {}
+            for i, label in enumerate(self.labels):
+                features = self.models[label][0]
+                features = features[:len(features) - (i if self.consider_labels_correlation else 0)]
+                positions[label] = index.get_indexer(features)
+                if (positions[label] < 0).any():
+                    missing = [feature for feature, position in zip(features, positions[label]) if position < 0]
+                    raise KeyError(f'features missing from the data: {missing}')
+            # the feature rows of a region always have the same columns, keep just the latest ones
+            self._column_positions = {columns: positions}
+        return positions
+
+    def save(self, path):
+        """ save every label model in one npz file at `path` """
+        arrays = {'labels': np.array(self.labels),
+                  'consider_labels_correlation': np.array(self.consider_labels_correlation),
+                  'report': np.array(json.dumps(self.report))}
+        for i, label in enumerate(self.labels):
+            features, coef, intercept, fill = self.models[label]
+            arrays.update({f'features_{i}': np.array(features), f'coef_{i}': coef,
+                           f'intercept_{i}': np.array(intercept), f'fill_{i}': fill})
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """ load a DistilledPredictor saved by `save` """
+        with np.load(path, allow_pickle=False) as arrays:
+            labels = arrays['labels'].tolist()
+            models = {label: (arrays[f'features_{i}'].tolist(), arrays[f'coef_{i}'], float(arrays[f'intercept_{i}']),
+                              arrays[f'fill_{i}'])
+                      for i, label in enumerate(labels)}
+            return cls(labels, models, bool(arrays['consider_labels_correlation']), json.loads(str(arrays['report'])))
@@ -0,0 +1,112 @@
+"""
+export the RawData forecasts as one float32 tensor shaped [model, region, run, lead_day]
+
+the tensor is a raw file opened with np.memmap plus a small json sidecar holding the axis labels, so every
+notebook kernel and training job on a host maps the same pages instead of reading the archive into its own
+memory. lead day i is the i-th forecast row (flag >= 1) of a run, the same indexing ProcessRawData uses, and
+missing runs or lead days are nan.
+
+an export never touches a tensor that is mapped: it writes a new version of the tensor next to the old one and then
+swaps in a sidecar naming it, so a kernel keeps the tensor it loaded and the next load_tensor maps the new one.
+
+export with:
+    python forecast_tensor.py
+then in a notebook:
+    tensor, labels = load_tensor()
+    ecmwf_eps = forecast_frame('ecmwf-eps', 'gw_hdd')
+"""
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import raw_data_store
+from process_raw_data import read_forecast
+
+TENSOR_FILE = 'RawData_tensor.f32'
+
+
+def export_tensor(path='RawData', tensor_file=TENSOR_FILE):
+    """
+    write every forecast file in `path` into the tensor file and its json sidecar
+    :param path: directory holding the RawData csv files
+    :param tensor_file: where to write the tensor, the labels go to `tensor_file`.json and the values to a new
+        `tensor_file`.{version} it points to. the versions before the previous one are removed
+    :return: shape of the tensor
+    """
+    files = {}
+    for file in raw_data_store.glob(os.path.join(path, '*.csv')):
+        parts = os.path.basename(file).split('.')
+        if len(parts) == 5:
+            files[(parts[0], parts[3], f'{parts[1]}.{parts[2]}')] = file
+    models = sorted(set(key[0] for key in files))
+    regions = sorted(set(key[1] for key in files))
+    runs = sorted(set(key[2] for key in files))
+
+    forecasts = {}
+    for key, file in files.items():
+        try:
+            forecasts[key] = read_forecast(file)
+        except pd.errors.EmptyDataError:
+            continue
+    lead_days = max((len(forecast) for forecast in forecasts.values()), default=0)
+
+    shape = (len(models), len(regions), len(runs), lead_days)
+    # the sidecar is the only thing replaced, the tensor it pointed to stays as it was for whoever has it mapped
+    version_file = f'{tensor_file}.{time.time_ns()}'
+    tensor = np.memmap(version_file, dtype=np.float32, mode='w+', shape=shape)
+    tensor[:] = np.nan
+    model_index = {model: i for i, model in enumerate(models)}
+    region_index = {region: i for i, region in enumerate(regions)}
+    run_index = {run: i for i, run in enumerate(runs)}
+    for (model, region, run), forecast in forecasts.items():
+        tensor[model_index[model], region_index[region], run_index[run], :len(forecast)] = forecast
+    tensor.flush()
+    del tensor
+
+    with open(tensor_file + '.json.tmp', 'w') as f:
+        json.dump({'file': os.path.basename(version_file), 'dtype': 'float32', 'shape': shape, 'models': models,
+                   'regions': regions, 'runs': runs, 'lead_days': lead_days}, f)
+    os.replace(tensor_file + '.json.tmp', tensor_file + '.json')
+
+    # a load_tensor that read the previous sidecar may not have mapped its tensor yet, the older ones are unused.
+    # removing a mapped file leaves its pages to the processes that have it mapped
+    versions = sorted(glob.glob(glob.escape(tensor_file) + '.[0-9]*'), key=lambda file: int(file.rsplit('.', 1)[1]))
+    for file in versions[:-2]:
+        os.remove(file)
+    return shape
+
+
+def load_tensor(tensor_file=TENSOR_FILE):
+    """
+    map the tensor read only, nothing is read until it is used
+    :param tensor_file: tensor written by export_tensor
+    :return: (np.memmap shaped [model, region, run, lead_day], dict of axis labels)
+    """
+    with open(tensor_file + '.json') as f:
+        labels = json.load(f)
+    # sidecars written before the tensor was versioned describe `tensor_file` itself
+    version_file = os.path.join(os.path.dirname(tensor_file), labels.get('file', os.path.basename(tensor_file)))
+    tensor = np.memmap(version_file, dtype=labels['dtype'], mode='r', shape=tuple(labels['shape']))
+    return tensor, labels
+
+
+def forecast_frame(model, region, tensor_file=TENSOR_FILE):
+    """
+    one model and region of the tensor as a dataframe, backed by the mapped file rather than a copy
+    :param model: e.g. ecmwf-eps
+    :param region: e.g. gw_hdd
+    :param tensor_file: tensor written by export_tensor
+    :return: dataframe indexed by run date and time with one column per lead day
+    """
+    tensor, labels = load_tensor(tensor_file)
+    values = tensor[labels['models'].index(model), labels['regions'].index(region)]
+    index = pd.to_datetime(labels['runs'], format='%Y%m%d.%H')
+    return pd.DataFrame(values, index=index, copy=False)
+
+
+if __name__ == '__main__':
+    print(f'wrote {TENSOR_FILE} with shape {export_tensor()}')
@@ -0,0 +1,153 @@
+"""
+stage level timing and memory instrumentation for the master_df build
+
+recording is off by default, every hook is then a global lookup returning a shared no-op. turn it on around a build:
+
+    with instrument.recording() as recorder:
+        ProcessRawData()
+    print(recorder.summary())
+    recorder.save('build_report.json')
+
+or run:
+    python process_raw_data.py --report build_report.json
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+_recorder = None
+_NULL_STAGE = nullcontext()
+
+
+def rss_mb():
+    """ current resident set size of the process in MB, None where it can't be read (only linux has /proc) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb():
+    """ peak resident set size of the process so far in MB, None where it can't be read """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class Recorder:
+    """ wall time, calls, RSS growth and rows of each stage of a build.
+
+        stages are keyed by name and accumulate over calls, a stage inside another one is counted in both.
+        the RSS growth of a stage is how much the resident set grew from its start to its end, the largest over its
+        calls, what it freed before ending isn't seen. the peak RSS of the whole process is in the report.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+
+    def _stats(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'rows': 0, 'dropped_rows': 0,
+                                         'rss_growth_mb': None}
+        return stats
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        start_rss = rss_mb()
+        try:
+            yield
+        finally:
+            stats = self._stats(name)
+            stats['calls'] += 1
+            stats['seconds'] += time.perf_counter() - start
+            rss = rss_mb()
+            if rss is not None and start_rss is not None:
+                previous = stats['rss_growth_mb']
+                stats['rss_growth_mb'] = rss - start_rss if previous is None else max(previous, rss - start_rss)
+
+    def rows(self, name, produced, dropped=0):
+        stats = self._stats(name)
+        stats['rows'] += int(produced)
+        stats['dropped_rows'] += int(dropped)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self):
+        """ the recording as a json serializable dict """
+        return {'seconds': time.perf_counter() - self.start,
+                'peak_rss_mb': peak_rss_mb(),
+                'dropped_rows': sum(stats['dropped_rows'] for stats in self.stages.values()),
+                'stages': self.stages,
+                'counts': self.counts}
+
+    def summary(self):
+        """ the recording on one line, the slowest stages first """
+        report = self.report()
+        stages = sorted(self.stages.items(), key=lambda item: -item[1]['seconds'])
+        peak = f", peak {report['peak_rss_mb']:.0f}MB" if report['peak_rss_mb'] is not None else ''
+        counts = ''.join(f', {name} {n}' for name, n in sorted(self.counts.items()))
+        return (f"{report['seconds']:.2f}s{peak}, {report['dropped_rows']} rows dropped{counts}: "
+                + ', '.join(f"{name} {stats['seconds']:.2f}s" for name, stats in stages))
+
+    def save(self, report_file):
+        with open(report_file, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+@contextmanager
+def recording():
+    """ record every stage run inside the block, a recording inside another one takes over until it ends """
+    global _recorder
+    previous, _recorder = _recorder, Recorder()
+    try:
+        yield _recorder
+    finally:
+        _recorder = previous
+
+
+def stage(name):
+    """ context manager timing a stage, a shared no-op when not recording """
+    if _recorder is None:
+        return _NULL_STAGE
+    return _recorder.stage(name)
+
+
+def timed(name):
+    """ decorator timing every call of a function as a stage """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _recorder.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def rows(name, produced, dropped=0):
+    """ add the rows a stage produced and the rows it dropped because of missing lead days, see count() for others """
+    if _recorder is not None:
+        _recorder.rows(name, produced, dropped)
+
+
+def count(name, n=1):
+    """ count an event, e.g. a file parsed by the pandas fallback or a run left out by the alignment """
+    if _recorder is not None:
+        _recorder.count(name, n)
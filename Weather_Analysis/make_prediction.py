@@ -1,9 +1,6 @@
-from MultiLabelPredictor import MultilabelPredictor
-import pandas as pd
-from autogluon.tabular import TabularDataset
+from prediction_service import PredictionClient
 
 degree_days = 'gw_hdd'
 
-multi_predictor = MultilabelPredictor.load(f"models/{degree_days}")
-
-
+# the predictors stay loaded in the prediction service, start it once with: python prediction_service.py
+multi_predictor = PredictionClient(degree_days)
@@ -0,0 +1,123 @@
+"""
+master_df as parquet, one file per month
+
+next to master_df_{degree_days}.pkl, ProcessRawData writes master_df_{degree_days}.parquet/YYYY-MM.parquet when a
+parquet engine (pyarrow) is installed. `read_master_df` only opens the months inside the requested date range and only
+reads the requested columns, so training on the last few months doesn't deserialize the whole history:
+
+    master_df = read_master_df('gw_hdd', last_months=24)
+    features = read_master_df('gw_hdd', start='2021-01-01', columns=['gfs-ens-bc_9', 'noon'])
+
+without pyarrow, or before the parquet files have been written, it reads the pickle and selects from it. either way
+the frame is checked against process_raw_data.SCHEMA.
+"""
+import importlib.util
+import os
+import shutil
+
+import pandas as pd
+
+HAVE_PARQUET = importlib.util.find_spec('pyarrow') is not None
+
+
+def partition_directory(degree_days, name=None):
+    """ directory holding the monthly parquet files of a region, `name` is the master_df file name without .pkl """
+    return f'{name or f"master_df_{degree_days}"}.parquet'
+
+
+def write_partitions(master_df, directory, since=None):
+    """
+    write master_df as one parquet file per month of its index
+    :param master_df: dataframe indexed by run date and time
+    :param directory: directory to write the files into
+    :param since: only rewrite the months from this date on, the earlier files are left as they are
+    """
+    months = master_df.index.strftime('%Y-%m')
+    if since is None:
+        # write next to the old files and swap them in, a reader never sees a half written directory
+        target, directory = directory, directory + '.tmp'
+        shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+    if since is not None:
+        first_month = pd.Timestamp(since).strftime('%Y-%m')
+        for filename in os.listdir(directory):
+            if filename.endswith('.parquet') and filename[:7] >= first_month:
+                os.remove(os.path.join(directory, filename))
+        master_df = master_df[months >= first_month]
+        months = months[months >= first_month]
+    for month, month_df in master_df.groupby(months):
+        month_df.to_parquet(os.path.join(directory, f'{month}.parquet'))
+    if since is None:
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(directory, target)
+
+
+def check_schema(master_df, schema, complete=True):
+    """
+    check master_df against its schema, columns stored with another dtype (e.g. the float64 of a build from before
+    the schema) are cast to it
+    :param master_df: dataframe to check
+    :param schema: dict of column to dtype
+    :param complete: whether master_df must hold every column of the schema rather than a selection
+    :return: master_df with the dtypes of the schema
+    :raises ValueError: if the index is not a DatetimeIndex, columns are missing or not in the schema, or a column
+        can't be cast
+    """
+    if not isinstance(master_df.index, pd.DatetimeIndex):
+        raise ValueError(f'master_df must be indexed by run date and time, not {type(master_df.index).__name__}')
+    unknown = [column for column in master_df.columns if column not in schema]
+    if unknown:
+        raise ValueError(f'master_df has columns that are not in the schema: {unknown}')
+    missing = [column for column in schema if column not in master_df.columns] if complete else []
+    if missing:
+        raise ValueError(f'master_df is missing columns of the schema: {missing}')
+    dtypes = {column: schema[column] for column in master_df.columns if master_df[column].dtype != schema[column]}
+    if not dtypes:
+        return master_df
+    try:
+        return master_df.astype(dtypes)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'master_df columns {list(dtypes)} don\'t match the schema: {e}') from e
+
+
+def read_master_df(degree_days, start=None, end=None, columns=None, last_months=None, name=None):
+    """
+    load master_df, only reading the months and columns asked for
+    :param degree_days: region, e.g. gw_hdd
+    :param start: first run date to include
+    :param end: last run date to include
+    :param columns: columns to read, all of them if not given
+    :param last_months: only the last n months that have runs, instead of start
+    :param name: master_df file name without .pkl, e.g. master_df_gw_hdd_00_06_12_18 for a four cycle build
+    :return: dataframe indexed by run date and time, with the dtypes of process_raw_data.SCHEMA
+    :raises ValueError: if the stored frame doesn't match the schema
+    """
+    # imported here as process_raw_data writes through this module
+    from process_raw_data import SCHEMA
+    name = name or f'master_df_{degree_days}'
+    if columns is not None:
+        unknown = [column for column in columns if column not in SCHEMA]
+        if unknown:
+            raise ValueError(f'columns not in the master_df schema: {unknown}')
+    directory = partition_directory(degree_days, name)
+    if not HAVE_PARQUET or not os.path.isdir(directory):
+        master_df = pd.read_pickle(f'{name}.pkl')
+        if last_months is not None and len(master_df):
+            first_month = master_df.index.to_period('M').unique()[-last_months:][0].start_time
+            start = first_month if start is None else max(pd.Timestamp(start), first_month)
+        master_df = master_df.loc[start:end]
+        return check_schema(master_df if columns is None else master_df[list(columns)], SCHEMA, columns is None)
+
+    months = sorted(filename[:7] for filename in os.listdir(directory) if filename.endswith('.parquet'))
+    if last_months is not None:
+        months = months[-last_months:]
+    if start is not None:
+        months = [month for month in months if month >= pd.Timestamp(start).strftime('%Y-%m')]
+    if end is not None:
+        months = [month for month in months if month <= pd.Timestamp(end).strftime('%Y-%m')]
+    if not months:
+        columns = list(SCHEMA) if columns is None else columns
+        return pd.DataFrame({column: pd.Series(dtype=SCHEMA[column]) for column in columns},
+                            index=pd.DatetimeIndex([]))
+    frames = [pd.read_parquet(os.path.join(directory, f'{month}.parquet'), columns=columns) for month in months]
+    return check_schema(pd.concat(frames).loc[start:end], SCHEMA, columns is None)
@@ -0,0 +1,294 @@
+"""
+long lived prediction service keeping the MultilabelPredictor of every region loaded
+
+a script loading the predictors itself pays for the autogluon import and unpickling every TabularPredictor before it
+predicts anything. the service loads them once, persisted in memory, and answers over localhost HTTP:
+
+    python prediction_service.py                    # every region with a models/{degree_days} directory
+    python prediction_service.py gw_hdd --port 8800
+
+scripts predict through PredictionClient, which has the predict(dataframe) of MultilabelPredictor:
+
+    predictor = PredictionClient('gw_hdd')
+    predictions = predictor.predict(features)
+    print(predictor.stats())
+
+the requests of a region that arrive while it is predicting are merged into one micro-batch, so concurrent callers
+share the chained per-label predict calls instead of queueing behind each other. GET /stats reports the request and
+row counts, p50 and p99 latency and throughput of every region.
+
+routes:
+    POST /predict/{degree_days}   {"columns": [...], "data": [[...], ...]} -> {"columns": labels, "data": [[...], ...]}
+    GET /stats                    {degree_days: stats}
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from process_raw_data import REGIONS, SCHEMA
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+
+class LatencyStats:
+    """ request latencies and counts of one region, percentiles and throughput are over the last `window` requests
+
+        :param window: number of recent requests kept
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        # (received, answered, rows) of the recent requests
+        self.recent = deque(maxlen=window)
+
+    def add_batch(self, requests, error=False):
+        """
+        record a predicted micro-batch
+        :param requests: list of (received, answered, rows) of its requests
+        :param error: whether the batch failed
+        """
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.rows += sum(rows for _, _, rows in requests)
+            if error:
+                self.errors += len(requests)
+            self.recent.extend(requests)
+
+    def report(self):
+        """ the stats as a json serializable dict, latencies in ms and throughput per second of the recent requests """
+        with self.lock:
+            recent = list(self.recent)
+            report = {'requests': self.requests, 'rows': self.rows, 'batches': self.batches, 'errors': self.errors,
+                      'mean_batch_requests': self.requests / self.batches if self.batches else None}
+        if not recent:
+            return {**report, 'p50_ms': None, 'p99_ms': None, 'requests_per_second': None, 'rows_per_second': None}
+        latencies = np.array([answered - received for received, answered, _ in recent]) * 1000
+        span = max(answered for _, answered, _ in recent) - min(received for received, _, _ in recent)
+        return {**report,
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'requests_per_second': len(recent) / span if span > 0 else None,
+                'rows_per_second': sum(rows for _, _, rows in recent) / span if span > 0 else None}
+
+
+class MicroBatcher:
+    """ predicts the feature rows of one region in micro-batches on a background thread.
+
+        the thread takes every request queued while it was busy, up to `max_batch_rows` rows, and predicts the ones
+        with the same columns with a single predict call. when that call fails its requests are predicted one by one,
+        so a bad request only fails itself.
+
+        :param predictor: MultilabelPredictor, or anything with a predict(dataframe) method
+        :param max_batch_rows: rows above which no more requests are added to a batch
+        :param max_wait: seconds to wait for more requests before predicting a batch, 0 only batches requests that
+            queued up while the previous batch was predicted
+    """
+
+    def __init__(self, predictor, max_batch_rows=4096, max_wait=0.0):
+        self.predictor = predictor
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, features):
+        """
+        predict feature rows together with whatever other requests are waiting, blocks until they are predicted
+        :param features: dataframe of feature rows
+        :return: dataframe of the predicted labels, in the order of `features`
+        """
+        future = Future()
+        self.queue.put((time.perf_counter(), features, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        rows = len(batch[0][1])
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_batch_rows:
+            try:
+                timeout = deadline - time.perf_counter()
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += len(request[1])
+        return batch
+
+    def _run(self):
+        while True:
+            # concatenating requests with other columns would fill the columns a request lacks with nan
+            groups = {}
+            for request in self._next_batch():
+                groups.setdefault(frozenset(request[1].columns), []).append(request)
+            for batch in groups.values():
+                self._predict(batch)
+
+    def _predict(self, batch):
+        try:
+            features = pd.concat([request[1] for request in batch], ignore_index=True) if len(batch) > 1 \
+                else batch[0][1]
+            predictions = self.predictor.predict(features).reset_index(drop=True)
+        except Exception as e:
+            if len(batch) > 1:
+                # the failure may be a single request's, the others are still answered
+                for request in batch:
+                    self._predict([request])
+                return
+            answered = time.perf_counter()
+            received, rows, future = batch[0]
+            future.set_exception(e)
+            self.stats.add_batch([(received, answered, len(rows))], error=True)
+            return
+        answered = time.perf_counter()
+        start = 0
+        for _, rows, future in batch:
+            future.set_result(predictions.iloc[start:start + len(rows)])
+            start += len(rows)
+        self.stats.add_batch([(received, answered, len(rows)) for received, rows, _ in batch])
+
+
+def load_predictors(degree_days=None, models_dir='models'):
+    """
+    load the MultilabelPredictor of each region with every label persisted in memory
+    :param degree_days: regions to load, every region of REGIONS with a saved predictor if not given
+    :param models_dir: directory holding a predictor directory per region
+    :return: dict of region to MultilabelPredictor
+    """
+    # autogluon is only imported by the service, never by its clients
+    from MultiLabelPredictor import MultilabelPredictor
+    if degree_days is None:
+        degree_days = [region for region in REGIONS if os.path.isdir(os.path.join(models_dir, region))]
+    return {region: MultilabelPredictor.load(os.path.join(models_dir, region), persist=True).preload()
+            for region in degree_days}
+
+
+def make_server(predictors, host=HOST, port=PORT, max_batch_rows=4096, max_wait=0.0):
+    """
+    HTTP server predicting with `predictors`, serve it with serve_forever()
+    :param predictors: dict of region to MultilabelPredictor
+    :param host: address to listen on, keep it local, there is no authentication
+    :param port: port to listen on, 0 for any free port
+    :param max_batch_rows: see MicroBatcher
+    :param max_wait: see MicroBatcher
+    :return: ThreadingHTTPServer, its batchers are in its `batchers` attribute
+    """
+    batchers = {region: MicroBatcher(predictor, max_batch_rows, max_wait) for region, predictor in predictors.items()}
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, {region: batcher.stats.report() for region, batcher in batchers.items()})
+            else:
+                self._send(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            region = self.path[len('/predict/'):] if self.path.startswith('/predict/') else None
+            if region not in batchers:
+                self._send(404, {'error': f'no predictor for {region}, serving {sorted(batchers)}'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                features = pd.DataFrame(request['data'], columns=request['columns'])
+                # the predictors were trained on the dtypes of the master_df schema
+                features = features.astype({column: SCHEMA[column] for column in features.columns if column in SCHEMA})
+            except (KeyError, TypeError, ValueError) as e:
+                self._send(400, {'error': f'bad request: {e}'})
+                return
+            try:
+                predictions = batchers[region].predict(features)
+            except Exception as e:
+                self._send(500, {'error': f'{type(e).__name__}: {e}'})
+                return
+            self._send(200, {'columns': list(predictions.columns), 'data': predictions.to_numpy().tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.batchers = batchers
+    return server
+
+
+class PredictionClient:
+    """ predicts through a running prediction service, in place of loading a MultilabelPredictor in the script.
+
+        :param degree_days: region, e.g. gw_hdd
+        :param url: address of the service
+        :param timeout: seconds to wait for an answer
+    """
+
+    def __init__(self, degree_days='gw_hdd', url=f'http://{HOST}:{PORT}', timeout=60):
+        self.degree_days = degree_days
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, body=None):
+        request = urllib.request.Request(self.url + path, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f'prediction service: {json.loads(e.read()).get("error")}') from e
+
+    def predict(self, data):
+        """
+        predict the labels of feature rows
+        :param data: dataframe of feature rows, label columns are ignored by the predictors
+        :return: dataframe of the predicted labels, indexed like `data`
+        """
+        # to_json writes NaN as null and float32 values without float64 noise
+        body = data.to_json(orient='split', index=False).encode()
+        response = self._request(f'/predict/{self.degree_days}', body)
+        return pd.DataFrame(response['data'], columns=response['columns'], index=data.index)
+
+    def stats(self):
+        """ stats of the service's regions, see LatencyStats.report """
+        return self._request('/stats')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('degree_days', nargs='*', help='regions to serve, every saved one by default')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--models', default='models')
+    parser.add_argument('--max-batch-rows', type=int, default=4096)
+    parser.add_argument('--max-wait', type=float, default=0.0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    predictors = load_predictors(args.degree_days or None, args.models)
+    server = make_server(predictors, args.host, args.port, args.max_batch_rows, args.max_wait)
+    print(f'loaded {sorted(predictors)} in {time.perf_counter() - start:.1f}s, '
+          f'serving on http://{args.host}:{server.server_address[1]}')
+    server.serve_forever()
@@ -1,257 +1,738 @@
-import glob
+import argparse
+import fnmatch
+import io
+import json
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, time
 
+import numpy as np
 import pandas as pd
 
+import instrument
+import raw_data_store
+from raw_data_bundles import INDEX_FILE
+from master_frame import HAVE_PARQUET, check_schema, partition_directory, write_partitions
+from run_catalog import MODELS, SKIP_RUNS
+
+# init hours used by default, and all of them
+CYCLES = ('00', '12')
+ALL_CYCLES = ('00', '06', '12', '18')
+REGIONS = ('gw_hdd', 'ew_cdd', 'pw_cdd')
+
+
+def extract_date_time(filename):
+    """
+    extract the date and time from the filename
+    :param filename:
+    :return:
+    """
+    parts = filename.split('.')
+    date = parts[1]
+    time = parts[2]
+    return date, time
+
+
+def get_date(df, file):
+    """get the date from the dataframe and the time from the filename and combine them into a datetime object
+    :param df: dataframe containing the date
+    :param file: filename containing the time
+    :return: datetime object
+    """
+    # date_str = df[df.iloc[:, 2] == 1].iloc[0]['Date']
+    date_str = str(file.split('.')[1])
+    time_str = str(file.split('.')[2])
+    # date = datetime.strptime(date_str, '%Y-%m-%d')
+    date = datetime.strptime(date_str, '%Y%m%d')
+    time_value = time(int(time_str), 0)
+    combined_datetime = datetime.combine(date.date(), time_value)
+    return combined_datetime
+
+
+def parse_forecast_file(file, forecast_only=False, dtype=np.float32, data=None):
+    """
+    parse a Date,Value,Flag forecast file straight into typed arrays, much cheaper than pd.read_csv for these
+    small files. anything that does not look like the expected layout is handed to pandas instead.
+    :param file: path of the file
+    :param forecast_only: keep only the rows with flag >= 1 (forecasts and normals)
+    :param dtype: dtype of the values, float64 keeps them identical to pd.read_csv
+    :param data: contents of the file when they have already been read, e.g. out of a bundle
+    :return: (dates as int64 days since 1970-01-01, values, flags as int8)
+    """
+    if data is None:
+        with open(file, 'rb') as f:
+            data = f.read()
+    lines = data.splitlines()
+    try:
+        if not lines or not lines[0].startswith(b'Date,Value,'):
+            raise ValueError(f'unexpected header in {file}')
+        fields = b','.join(line for line in lines[1:] if line).split(b',')
+        if len(fields) % 3 != 0:
+            raise ValueError(f'unexpected number of columns in {file}')
+        fields = np.array(fields)
+        dates = fields[0::3].astype('datetime64[D]').astype(np.int64)
+        values = fields[1::3].astype(np.float64).astype(dtype, copy=False)
+        flags = fields[2::3].astype(np.int8)
+    except ValueError:
+        instrument.count('pandas fallback')
+        df = pd.read_csv(io.BytesIO(data))
+        dates = pd.to_datetime(df['Date']).to_numpy().astype('datetime64[D]').astype(np.int64)
+        values = df['Value'].to_numpy(dtype=dtype)
+        flags = df[df.columns[2]].to_numpy(dtype=np.int8)
+    if forecast_only:
+        forecast = flags >= 1
+        return dates[forecast], values[forecast], flags[forecast]
+    return dates, values, flags
+
+
+# method, CRC, compressed size, name, extra field and comment lengths and local header offset of a central
+# directory entry, which is followed by the name, extra field and comment
+CENTRAL_DIRECTORY = struct.Struct('<10xH4xLL4xHHH8xL')
+
+
+class RawDataBundles:
+    """ read only view of a directory of per-month zip bundles written by raw_data_bundles.py.
+
+        members are addressed by the paths the loose files would have, e.g.
+        RawData_bundles/ecmwf.20200101.00.gw_hdd.csv. each bundle is memory mapped and a member is sliced out at the
+        offset its central directory entry gives and inflated, which skips the ZipInfo and file object zipfile sets up
+        for every member. listing only reads the bundles.json index.
+
+        :param path: directory holding the bundles
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # taken before reading, a bundles.json rewritten meanwhile is reloaded by get_bundles
+        self.mtime = os.stat(os.path.join(path, INDEX_FILE)).st_mtime_ns
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.filenames = [filename for month in sorted(self.index) for filename in self.index[month]]
+        self.months = {filename: month for month in self.index for filename in self.index[month]}
+        # month -> (mapped bundle, members from open_bundle), opened on first use, each process maps its own
+        self.bundles = {}
+
+    def glob(self, pattern):
+        """
+        match a glob pattern against the members of the bundles
+        :param pattern: pattern in the form used with glob.glob, e.g. RawData_bundles/ecmwf.*.*.gw_hdd.csv
+        :return: list of matching paths
+        """
+        directory, name_pattern = os.path.split(pattern)
+        return [os.path.join(directory, filename) for filename in fnmatch.filter(self.filenames, name_pattern)]
 
-def ProcessRawData(path="RawData", degree_days='gw_hdd'):
-    path = "RawData"
-
-    def extract_date_time(filename):
+    def open_bundle(self, month):
         """
-        extract the date and time from the filename
-        :param filename:
-        :return:
+        map a bundle and read its central directory
+        :param month: YYYY-MM
+        :return: (mapped bundle, dict of member name to (header offset, compressed size, compression, CRC))
         """
-        parts = filename.split('.')
-        date = parts[1]
-        time = parts[2]
-        return date, time
-
-    def get_date(df, file):
-        """get the date from the dataframe and the time from the filename and combine them into a datetime object
-        :param df: dataframe containing the date
-        :param file: filename containing the time
-        :return: datetime object
+        with open(os.path.join(self.path, f'{month}.zip'), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # the end of central directory record is the last 22 bytes unless the zip has a comment
+            end = data.rfind(b'PK\x05\x06', max(len(data) - 22 - 0xffff, 0))
+            n_members, offset = struct.unpack_from('<6xH4xL', data, end + 4) if end >= 0 else (0xffff, 0xffffffff)
+            if n_members == 0xffff or offset == 0xffffffff:
+                # zip64, read through zipfile, which parses the central directory straight from the file
+                with zipfile.ZipFile(f) as zip_file:
+                    return data, {info.filename: (info.header_offset, info.compress_size, info.compress_type,
+                                                  info.CRC) for info in zip_file.infolist()}
+        # only the fields read() needs, building a ZipInfo for every member costs more than reading them
+        members = {}
+        for _ in range(n_members):
+            (compression, crc, compress_size, name_length, extra_length, comment_length,
+             header_offset) = CENTRAL_DIRECTORY.unpack_from(data, offset)
+            name = data[offset + 46:offset + 46 + name_length].decode()
+            members[name] = header_offset, compress_size, compression, crc
+            offset += 46 + name_length + extra_length + comment_length
+        return data, members
+
+    def read(self, file):
         """
-        # date_str = df[df.iloc[:, 2] == 1].iloc[0]['Date']
-        date_str = str(file.split('.')[1])
-        time_str = str(file.split('.')[2])
-        # date = datetime.strptime(date_str, '%Y-%m-%d')
-        date = datetime.strptime(date_str, '%Y%m%d')
-        time_value = time(int(time_str), 0)
-        combined_datetime = datetime.combine(date.date(), time_value)
-        return combined_datetime
-
-    degree_days = degree_days
-    ecmwf_files = glob.glob(path + f'/ecmwf.*.[01][02].{degree_days}.csv')
-    ecmwf_sorted_files = sorted(ecmwf_files, key=lambda x: (x.split('.')[1], x.split('.')[2]))[3:]
-
-    ecmwf_eps_files = glob.glob(path + f'/ecmwf-eps.*.[01][02].{degree_days}.csv')
-    ecmwf_eps_sorted_files = sorted(ecmwf_eps_files, key=lambda x: (x.split('.')[1], x.split('.')[2]))[2:]
-
-    gfs_ens_bc_files = glob.glob(path + f'/gfs-ens-bc.*.[01][02].{degree_days}.csv')
-    gfs_ens_bc_sorted_files = sorted(gfs_ens_bc_files, key=lambda x: (x.split('.')[1], x.split('.')[2]))[2:]
-
-    cmc_ens_files = glob.glob(path + f'/cmc-ens.*.[01][02].{degree_days}.csv')
-    cmc_ens_sorted_files = sorted(cmc_ens_files, key=lambda x: (x.split('.')[1], x.split('.')[2]))[2:]
-    for _ in range(2):
-        set1 = set((extract_date_time(filename) for filename in ecmwf_sorted_files))
-        set2 = set((extract_date_time(filename) for filename in ecmwf_eps_sorted_files))
-
-        ecmwf_sorted_files = [filename for filename in ecmwf_sorted_files if extract_date_time(filename) in set2]
-        ecmwf_eps_sorted_files = [filename for filename in ecmwf_eps_sorted_files if
-                                  extract_date_time(filename) in set1]
-        cmc_ens_sorted_files = [filename for filename in cmc_ens_sorted_files if extract_date_time(filename) in set1]
-
-        master_set = set((extract_date_time(filename) for filename in cmc_ens_sorted_files))
-        gfs_ens_bc_sorted_files = [filename for filename in gfs_ens_bc_sorted_files if
-                                   extract_date_time(filename) in master_set]
-
-        master_set = set((extract_date_time(filename) for filename in gfs_ens_bc_sorted_files))
-
-        ecmwf_sorted_files = [filename for filename in ecmwf_sorted_files if extract_date_time(filename) in master_set]
-        ecmwf_eps_sorted_files = [filename for filename in ecmwf_eps_sorted_files if
-                                  extract_date_time(filename) in master_set]
-        gfs_ens_bc_sorted_files = [filename for filename in gfs_ens_bc_sorted_files if
-                                   extract_date_time(filename) in master_set]
-        cmc_ens_sorted_files = [filename for filename in cmc_ens_sorted_files if
-                                extract_date_time(filename) in master_set]
-
-    ecmwf_eps_change_df = pd.DataFrame(columns=['ecmwf-eps_9', 'ecmwf-eps_10', 'ecmwf-eps_11', 'ecmwf-eps_12',
-                                                'ecmwf-eps_13', 'ecmwf-eps_14'])
-    passed_rows = []
-
-    for i in range(1, len(ecmwf_eps_sorted_files)):
-        ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i])
-        ecmwf_eps_df = ecmwf_eps_df[ecmwf_eps_df[ecmwf_eps_df.columns[2]] >= 1]
-        prev_ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i - 1])
-        prev_ecmwf_eps_df = prev_ecmwf_eps_df[prev_ecmwf_eps_df[prev_ecmwf_eps_df.columns[2]] >= 1]
-
-        date = get_date(ecmwf_eps_df, ecmwf_eps_sorted_files[i])
-        prev_date = get_date(prev_ecmwf_eps_df, ecmwf_eps_sorted_files[i - 1])
-        d2 = str(date)[:10]
-        d1 = str(prev_date)[:10]
-
-        if d2 == d1:
-            offset = 1
-        else:
-            offset = 0
-
-        changes = []
-        try:
-            for day in range(8, 14):
-                changes.append(ecmwf_eps_df.iloc[day]['Value'] - prev_ecmwf_eps_df.iloc[day + offset]['Value'])
-            new_row = pd.DataFrame([changes], columns=ecmwf_eps_change_df.columns, index=[date])
-            ecmwf_eps_change_df = pd.concat([ecmwf_eps_change_df, new_row])
-        except IndexError:
-            #print(f"error on {date}")
-            passed_rows.append(i)
-
-    ecmwf_change_df = pd.DataFrame(columns=['ecmwf_diff_8', 'ecmwf_diff_9', ])
-
-    for i in range(1, len(ecmwf_sorted_files)):
-        ecmwf_df = pd.read_csv(ecmwf_sorted_files[i])
-        ecmwf_df = ecmwf_df[ecmwf_df[ecmwf_df.columns[2]] >= 1]
-        ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i - 1])
-        ecmwf_eps_df = ecmwf_eps_df[ecmwf_eps_df[ecmwf_eps_df.columns[2]] >= 1]
-
-        try:
-            ecmwf = ecmwf_df.iloc[8]
-            ecmwf_eps = ecmwf_eps_df.iloc[9]
-        except IndexError:
-            #print(f"error on row: {i}")
-            passed_rows.append(i)
-            continue
-
-        date = get_date(ecmwf_df, ecmwf_sorted_files[i])
-        prev_date = get_date(ecmwf_eps_df, ecmwf_eps_sorted_files[i - 1])
-        d2 = str(date)[:10]
-        d1 = str(prev_date)[:10]
-        if d2 == d1:
-            offset = 1
-        else:
-            offset = 0
-
-        changes = []
-        try:
-            for day in range(7, 9):
-                changes.append(ecmwf_df.iloc[day]['Value'] - ecmwf_eps_df.iloc[day + offset]['Value'])
-            new_row = pd.DataFrame([changes], columns=ecmwf_change_df.columns, index=[date])
-            ecmwf_change_df = pd.concat([ecmwf_change_df, new_row])
-        except IndexError:
-            #print(f"error on {date}")
-            passed_rows.append(i)
-
-    gfs_ens_bc_change_df = pd.DataFrame(columns=['gfs-ens-bc_9', 'gfs-ens-bc_10', 'gfs-ens-bc_11', 'gfs-ens-bc_12',
-                                                 'gfs-ens-bc_13', 'gfs-ens-bc_14'])
-
-    for i in range(1, len(gfs_ens_bc_sorted_files)):
-        gfs_ens_bc_df = pd.read_csv(gfs_ens_bc_sorted_files[i])
-        gfs_ens_bc_df = gfs_ens_bc_df[gfs_ens_bc_df[gfs_ens_bc_df.columns[2]] >= 1]
-        prev_ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i - 1])
-        prev_ecmwf_eps_df = prev_ecmwf_eps_df[prev_ecmwf_eps_df[prev_ecmwf_eps_df.columns[2]] >= 1]
-
-        try:
-            date = get_date(gfs_ens_bc_df, gfs_ens_bc_sorted_files[i])
-            prev_date = get_date(prev_ecmwf_eps_df, ecmwf_eps_sorted_files[i - 1])
-        except IndexError:
-            #print(f"error on row: {i}")
-            passed_rows.append(i)
-            continue
-
-        d2 = str(date)[:10]
-        d1 = str(prev_date)[:10]
-        if d2 == d1:
-            offset = 1
-        else:
-            offset = 0
-
-        changes = []
-        try:
-            for day in range(8, 14):
-                changes.append(gfs_ens_bc_df.iloc[day]['Value'] - prev_ecmwf_eps_df.iloc[day + offset]['Value'])
-            new_row = pd.DataFrame([changes], columns=gfs_ens_bc_change_df.columns, index=[date])
-            gfs_ens_bc_change_df = pd.concat([gfs_ens_bc_change_df, new_row])
-        except IndexError:
-            #print(f"error on {date}")
-            passed_rows.append(i)
-
-    cmc_ens_change_df = pd.DataFrame(columns=['cmc-ens_9', 'cmc-ens_10', 'cmc-ens_11', 'cmc-ens_12',
-                                              'cmc-ens_13', 'cmc-ens_14'])
-
-    for i in range(1, len(cmc_ens_sorted_files)):
-        cmc_ens_df = pd.read_csv(cmc_ens_sorted_files[i])
-        cmc_ens_df = cmc_ens_df[cmc_ens_df[cmc_ens_df.columns[2]] >= 1]
-        gfs_ens_bc_df = pd.read_csv(gfs_ens_bc_sorted_files[i])
-        gfs_ens_bc_df = gfs_ens_bc_df[gfs_ens_bc_df[gfs_ens_bc_df.columns[2]] >= 1]
-        date = get_date(cmc_ens_df, cmc_ens_sorted_files[i])
-
-        changes = []
-        try:
-            for day in range(8, 14):
-                changes.append(cmc_ens_df.iloc[day]['Value'] - gfs_ens_bc_df.iloc[day]['Value'])
-            new_row = pd.DataFrame([changes], columns=cmc_ens_change_df.columns, index=[date])
-            cmc_ens_change_df = pd.concat([cmc_ens_change_df, new_row])
-        except IndexError:
-            #print(f"error on {date}")
-            passed_rows.append(i)
-
-    day_8_error = pd.DataFrame(columns=['day_8_error'])
-
-    for i in range(1, len(ecmwf_eps_sorted_files)):
-        ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i])
-        ecmwf_eps_df = ecmwf_eps_df[ecmwf_eps_df[ecmwf_eps_df.columns[2]] >= 1]
-        prev_ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i - 1])
-        prev_ecmwf_eps_df = prev_ecmwf_eps_df[prev_ecmwf_eps_df[prev_ecmwf_eps_df.columns[2]] >= 1]
-
-        date = get_date(ecmwf_eps_df, ecmwf_eps_sorted_files[i])
-        prev_date = get_date(prev_ecmwf_eps_df, ecmwf_eps_sorted_files[i - 1])
-        d2 = str(date)[:10]
-        d1 = str(prev_date)[:10]
-
-        if d2 == d1:
-            offset = 1
-        else:
-            offset = 0
-        day = 7
-        changes = []
+        read a member without extracting it
+        :param file: path of the file
+        :return: contents of the file
+        """
+        name = os.path.basename(file)
+        month = self.months[name]
+        bundle = self.bundles.get(month)
+        if bundle is None:
+            bundle = self.bundles[month] = self.open_bundle(month)
+        data, members = bundle
+        header_offset, compress_size, compression, crc = members[name]
+        # the member starts after its local header, whose name and extra field lengths can differ from the
+        # central directory
+        name_length, extra_length = struct.unpack_from('<HH', data, header_offset + 26)
+        start = header_offset + 30 + name_length + extra_length
+        member = data[start:start + compress_size]
+        if compression == zipfile.ZIP_DEFLATED:
+            member = zlib.decompress(member, -zlib.MAX_WBITS)
+        elif compression != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(os.path.join(self.path, f'{month}.zip')) as zip_file:
+                member = zip_file.read(name)
+        if zlib.crc32(member) != crc:
+            raise zipfile.BadZipFile(f'bad CRC for {file}')
+        return member
+
+
+_bundles = {}
+
+
+def get_bundles(path, refresh=False):
+    """
+    the bundles of a directory, loaded once per process
+    :param path: directory that may hold bundles instead of loose files
+    :param refresh: load bundles.json again if it changed since it was loaded, e.g. months were packed since
+    :return: RawDataBundles, or None if `path` has no bundles.json
+    """
+    bundles = _bundles.get(path, False)
+    if refresh and bundles is not False:
         try:
-            changes.append(ecmwf_eps_df.iloc[day]['Value'] - prev_ecmwf_eps_df.iloc[day + offset]['Value'])
-            new_row = pd.DataFrame([changes], columns=day_8_error.columns, index=[date])
-            day_8_error = pd.concat([day_8_error, new_row])
-        except IndexError:
-            #print(f"error on {date}")
-            passed_rows.append(i)
-
-    errors_df = pd.DataFrame(columns=['error_9', 'error_10', 'error_11', 'error_12', 'error_13', 'error_14'])
-
-    for i in range(2, len(ecmwf_eps_sorted_files)):
-        ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i - 1])
-        ecmwf_eps_df = ecmwf_eps_df[ecmwf_eps_df[ecmwf_eps_df.columns[2]] >= 1]
-        prev_ecmwf_eps_df = pd.read_csv(ecmwf_eps_sorted_files[i - 2])
-        prev_ecmwf_eps_df = prev_ecmwf_eps_df[prev_ecmwf_eps_df[prev_ecmwf_eps_df.columns[2]] >= 1]
-
-        date = get_date(ecmwf_eps_df, ecmwf_eps_sorted_files[i])
-        prev_date = get_date(prev_ecmwf_eps_df, ecmwf_eps_sorted_files[i - 1])
-        d2 = str(date)[:10]
-        d1 = str(prev_date)[:10]
-
-        if d2 != d1:
-            offset = 1
+            mtime = os.stat(os.path.join(path, INDEX_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != (bundles.mtime if bundles is not None else None):
+            bundles = False
+    if bundles is False:
+        bundles = _bundles[path] = RawDataBundles(path) if os.path.exists(os.path.join(path, INDEX_FILE)) else None
+    return bundles
+
+
+def glob_files(pattern):
+    """ list files like glob.glob, from the bundles or the store when the directory has them """
+    # listing starts every build, a long running process sees the months packed since its last build
+    bundles = get_bundles(os.path.dirname(pattern), refresh=True)
+    if bundles is not None:
+        return bundles.glob(pattern)
+    return raw_data_store.glob(pattern)
+
+
+def base_cycle(cycle):
+    """
+    ecmwf and cmc-ens only run at 00z and 12z, the 06z and 18z rows use their run from six hours earlier. both have
+    their first forecast row on the same day so their lead days line up
+    :param cycle: init hour, e.g. '18'
+    :return: init hour of the ecmwf and cmc-ens run used with it, e.g. '12'
+    """
+    return f'{int(cycle) // 12 * 12:02d}'
+
+
+def sort_files(path="RawData", degree_days='gw_hdd', catalog=None, cycles=CYCLES):
+    """
+    find the ecmwf, ecmwf-eps, gfs-ens-bc and cmc-ens runs and keep only the runs all four models share
+    :param path: directory holding the RawData csv files
+    :param degree_days: region, e.g. gw_hdd
+    :param catalog: RunCatalog to look the runs up in instead of globbing `path`
+    :param cycles: init hours to include, ALL_CYCLES adds the 06z and 18z runs of ecmwf-eps and gfs-ens-bc
+    :return: (ecmwf, ecmwf-eps, gfs-ens-bc, cmc-ens) lists of files, sorted by date and time and aligned by index
+    """
+    if catalog is not None:
+        with instrument.stage('catalog'):
+            return catalog.aligned_files(degree_days, cycles)
+    with instrument.stage('list'):
+        files = {model: glob_files(path + f'/{model}.*.*.{degree_days}.csv') for model in MODELS}
+    return align_files(files, cycles)
+
+
+def sort_all_files(path="RawData", regions=REGIONS, catalog=None, cycles=CYCLES):
+    """
+    sort_files for several regions from a single listing of `path`
+    :param path: directory holding the RawData csv files
+    :param regions: regions to align
+    :param catalog: RunCatalog to look the runs up in instead of listing `path`
+    :param cycles: init hours to include
+    :return: dict of region to the output of sort_files
+    """
+    if catalog is not None:
+        with instrument.stage('catalog'):
+            return {region: catalog.aligned_files(region, cycles) for region in regions}
+    files = {region: {model: [] for model in MODELS} for region in regions}
+    with instrument.stage('list'):
+        for file in glob_files(path + '/*.csv'):
+            parts = os.path.basename(file).split('.')
+            if len(parts) == 5 and parts[3] in files and parts[0] in files[parts[3]]:
+                files[parts[3]][parts[0]].append(file)
+    return {region: align_files(region_files, cycles) for region, region_files in files.items()}
+
+
+@instrument.timed('align')
+def align_files(files, cycles=CYCLES):
+    """
+    skip the earliest runs of each model and keep the runs all four models share
+    :param files: dict of model to the files of one region
+    :param cycles: init hours to include
+    :return: (ecmwf, ecmwf-eps, gfs-ens-bc, cmc-ens) lists of files, sorted by date and time and aligned by index
+    """
+    runs = {}
+    for model in MODELS:
+        model_files = [file for file in files[model] if extract_date_time(os.path.basename(file))[1] in cycles]
+        model_files = sorted(model_files, key=lambda x: extract_date_time(os.path.basename(x)))[SKIP_RUNS[model]:]
+        runs[model] = {extract_date_time(os.path.basename(file)): file for file in model_files}
+
+    sorted_files = ([], [], [], [])
+    for date, cycle in sorted(runs['ecmwf-eps'].keys() & runs['gfs-ens-bc'].keys()):
+        base_run = (date, base_cycle(cycle))
+        if base_run in runs['ecmwf'] and base_run in runs['cmc-ens']:
+            model_runs = [base_run, (date, cycle), (date, cycle), base_run]
+            for model_files, model, run in zip(sorted_files, MODELS, model_runs):
+                model_files.append(runs[model][run])
+    instrument.rows('align', len(sorted_files[1]))
+    instrument.count('unaligned runs', len(runs['ecmwf-eps']) - len(sorted_files[1]))
+    return sorted_files
+
+
+def read_forecast(file):
+    """
+    parse the forecast rows of a single file
+    :param file: path of the file
+    :return: values of the rows with flag >= 1
+    """
+    bundles = get_bundles(os.path.dirname(file))
+    if bundles is not None:
+        return parse_forecast_file(file, forecast_only=True, dtype=np.float64, data=bundles.read(file))[1]
+    store = raw_data_store.get_store()
+    values = store.get_values(file) if store is not None else None
+    if values is None or len(values[0]) == 0:
+        return parse_forecast_file(file, forecast_only=True, dtype=np.float64)[1]
+    day, value, flag = values
+    return value[flag >= 1]
+
+
+def read_forecast_chunk(files):
+    """
+    parse a chunk of files in a worker process
+    :param files: list of files
+    :return: (values, lengths), the forecast values of every file concatenated to keep the result compact
+    """
+    forecasts = [read_forecast(file) for file in files]
+    lengths = np.array([len(forecast) for forecast in forecasts], dtype=np.int64)
+    return np.concatenate(forecasts) if forecasts else np.zeros(0), lengths
+
+
+class ForecastCache:
+    """ LRU cache of the parsed forecast rows (flag >= 1) of each file, shared by every model in a build.
+
+        :param max_bytes: memory cap for the cached values, the least recently used files are evicted past it
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.forecasts = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.forecasts)
+
+    def get(self, file):
+        """
+        get the forecast values of a file, parsing it on a miss
+        :param file: path of the file
+        :return: values of the rows with flag >= 1
+        """
+        forecast = self.forecasts.get(file)
+        if forecast is not None:
+            self.forecasts.move_to_end(file)
+            self.hits += 1
+            return forecast
+        self.misses += 1
+        forecast = read_forecast(file)
+        self.put(file, forecast)
+        return forecast
+
+    def prefetch(self, files, workers=1):
+        """
+        parse the files that are not cached yet, fanned out over a process pool when `workers` > 1
+        the files are only spread over processes when they are read from disk, the store is faster in process
+        :param files: list of files
+        :param workers: number of worker processes
+        """
+        missing = [file for file in dict.fromkeys(files) if file not in self.forecasts]
+        if workers <= 1 or len(missing) < 2 * workers or raw_data_store.get_store() is not None:
+            for file in missing:
+                self.get(file)
+            return
+        # a few chunks per worker balances the load while keeping the number of round trips small
+        chunksize = -(-len(missing) // (workers * 4))
+        chunks = [missing[i:i + chunksize] for i in range(0, len(missing), chunksize)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk, (values, lengths) in zip(chunks, executor.map(read_forecast_chunk, chunks)):
+                for file, forecast in zip(chunk, np.split(values, np.cumsum(lengths)[:-1])):
+                    self.misses += 1
+                    self.put(file, forecast)
+
+    def put(self, file, forecast):
+        """ add the forecast values of a file and evict the least recently used files past the memory cap """
+        if file in self.forecasts:
+            self.nbytes -= self.forecasts.pop(file).nbytes
+        self.forecasts[file] = forecast
+        self.nbytes += forecast.nbytes
+        while self.nbytes > self.max_bytes and len(self.forecasts) > 1:
+            _, evicted = self.forecasts.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def stats(self):
+        """ hit and miss counts and the current size of the cache """
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(self.forecasts), 'bytes': self.nbytes}
+
+
+def load_forecasts(files, cache=None):
+    """
+    read the forecast rows (flag >= 1) of each file into a dense array, one row per run and one column per lead day
+    :param files: list of files
+    :param cache: ForecastCache to read the files through
+    :return: (values, lengths) where values is padded with nan past the number of forecast rows in each file
+    """
+    if cache is None:
+        cache = ForecastCache()
+    forecasts = [cache.get(file) for file in files]
+    lengths = np.array([len(forecast) for forecast in forecasts], dtype=np.int64)
+    values = np.full((len(files), max(lengths.max(initial=0), 1)), np.nan)
+    for i, forecast in enumerate(forecasts):
+        values[i, :len(forecast)] = forecast
+    return values, lengths
+
+
+def take(forecasts, runs, days, every=True):
+    """
+    pick lead days out of a dense forecast array
+    :param forecasts: (values, lengths) from load_forecasts
+    :param runs: array of run positions, one per output row
+    :param days: lead days to pick for each output row, shape (len(runs), n_days)
+    :param every: whether the mask is of the rows where every lead day exists, rather than of each lead day
+    :return: (picked values, mask of the rows where every lead day exists in the file, or of the lead days that do)
+    """
+    values, lengths = forecasts
+    days = np.broadcast_to(days, (len(runs), np.shape(days)[-1]))
+    picked = values[runs[:, None], np.minimum(days, values.shape[1] - 1)]
+    exists = days < lengths[runs, None]
+    return picked, exists.all(axis=1) if every else exists
+
+
+FeatureSpec = namedtuple('FeatureSpec', ['name', 'model', 'reference', 'leads', 'aggregation', 'same_run',
+                                         'min_lengths'], defaults=['each', False, None])
+FeatureSpec.__doc__ = """ change of `model` against `reference` over a window of lead days.
+
+    name : column name, or column prefix when aggregation is 'each' (columns are named {name}_{lead + 1})
+    model, reference : one of ecmwf, ecmwf-eps, gfs-ens-bc, cmc-ens
+    leads : lead days (positions of the forecast rows) of `model`
+    aggregation : 'each' for one column per lead day, 'sum' or 'mean' for one column over the window
+    same_run : compare against the reference run made at the same time instead of the run before it. the run before
+        is shifted one lead day when both were made on the same day so the same dates are compared
+    min_lengths : (model, reference) number of forecast rows below which a run is skipped whatever the shift
+"""
+
+AGGREGATIONS = {'sum': np.sum, 'mean': np.mean}
+
+# feature columns of master_df, in order
+FEATURES = [
+    FeatureSpec('gfs-ens-bc', 'gfs-ens-bc', 'ecmwf-eps', range(8, 14)),
+    FeatureSpec('cmc-ens', 'cmc-ens', 'gfs-ens-bc', range(8, 14), same_run=True),
+    FeatureSpec('ecmwf_diff', 'ecmwf', 'ecmwf-eps', range(7, 9), min_lengths=(9, 10)),
+    FeatureSpec('day_8_error', 'ecmwf-eps', 'ecmwf-eps', range(7, 8), aggregation='sum'),
+]
+# label columns of master_df, they come after the error columns
+LABELS = [
+    FeatureSpec('ecmwf-eps', 'ecmwf-eps', 'ecmwf-eps', range(8, 14)),
+]
+ERROR_COLUMNS = ['error_9', 'error_10', 'error_11', 'error_12', 'error_13', 'error_14']
+# last lead day read from the ecmwf-eps run a row is compared against, before the shift between the two runs
+REFERENCE_LEAD = max(max(spec.leads) for spec in FEATURES + LABELS
+                     if not spec.same_run and spec.reference == 'ecmwf-eps')
+
+
+def feature_columns(spec):
+    """ names of the columns a FeatureSpec adds """
+    if spec.aggregation == 'each':
+        return [f'{spec.name}_{lead + 1}' for lead in spec.leads]
+    return [spec.name]
+
+
+# columns of master_df in order and their dtypes, read_master_df checks a loaded master_df against it
+SCHEMA = {column: dtype
+          for columns, dtype in [([column for spec in FEATURES for column in feature_columns(spec)], np.float32),
+                                 (ERROR_COLUMNS, np.float32),
+                                 (['noon'], np.int8),
+                                 ([column for spec in LABELS for column in feature_columns(spec)], np.float32)]
+          for column in columns}
+
+
+def load_runs(ecmwf_sorted_files, ecmwf_eps_sorted_files, gfs_ens_bc_sorted_files, cmc_ens_sorted_files,
+              cache=None, workers=1, cycles=CYCLES):
+    """
+    read every model of a set of aligned runs into dense arrays
+    :param cache: ForecastCache shared by the models, a new one is used if not given
+    :param workers: number of processes to parse the files with
+    :param cycles: init hours the runs were aligned with
+    :return: (dict of model to (values, lengths), run dates, lead day offset of each run against its reference run,
+        position of the reference run of each run or -1 if it has none). the reference run is the run before it for
+        CYCLES. with the 06z and 18z runs, whose ecmwf-eps files stop short of REFERENCE_LEAD, it is the latest run
+        before it that has every lead day up to REFERENCE_LEAD once shifted, usually the last 00z or 12z run
+    """
+    if cache is None:
+        cache = ForecastCache()
+    files = {'ecmwf': ecmwf_sorted_files, 'ecmwf-eps': ecmwf_eps_sorted_files,
+             'gfs-ens-bc': gfs_ens_bc_sorted_files, 'cmc-ens': cmc_ens_sorted_files}
+    with instrument.stage('parse'):
+        cache.prefetch([file for model_files in files.values() for file in model_files], workers)
+    forecasts = {}
+    for model, model_files in files.items():
+        with instrument.stage(f'load {model}'):
+            forecasts[model] = load_forecasts(model_files, cache)
+
+    dates = [get_date(None, file) for file in ecmwf_eps_sorted_files]
+    offset = np.zeros(len(dates), dtype=np.int64)
+    reference = np.arange(-1, len(dates) - 1)
+    if tuple(cycles) == CYCLES:
+        # a run made on the same day as the run before it is one lead day ahead of it. the 00z/12z master_df has
+        # always been built this way, it only differs from the rule below across missing runs
+        run_days = np.array([date.toordinal() for date in dates], dtype=np.int64)
+        offset[1:] = run_days[1:] == run_days[:-1]
+    else:
+        # the first forecast row is the init date for 00z/06z runs and the day after for 12z/18z runs, a run is
+        # that many lead days ahead of the run before it
+        first_days = np.array([date.toordinal() + (date.hour >= 12) for date in dates], dtype=np.int64)
+        lengths = forecasts['ecmwf-eps'][1]
+        for run in range(1, len(dates)):
+            reference[run] = -1
+            for previous in range(run - 1, max(run - 1 - len(ALL_CYCLES), -1), -1):
+                if lengths[previous] > REFERENCE_LEAD + first_days[run] - first_days[previous]:
+                    reference[run] = previous
+                    offset[run] = first_days[run] - first_days[previous]
+                    break
+    return forecasts, dates, offset, reference
+
+
+def history_runs(cycles=CYCLES):
+    """ number of aligned runs a row is built from, itself included: its run, its reference and the reference's """
+    return 3 if tuple(cycles) == CYCLES else 2 * len(ALL_CYCLES) + 1
+
+
+def feature_frame(dates, runs, values, mask, columns):
+    """ dataframe of the rows in `mask`, indexed by the dates of their runs """
+    index = pd.DatetimeIndex([dates[i] for i in runs[mask]])
+    return pd.DataFrame(values[mask], columns=columns, index=index)
+
+
+def compute_feature(spec, forecasts, dates, offset, reference, partial=False):
+    """
+    compute one FeatureSpec for every run at once, runs missing any of the lead days are left out
+    :param spec: FeatureSpec
+    :param forecasts, dates, offset, reference: output of load_runs
+    :param partial: keep the runs missing some of the lead days of an 'each' spec, nan in the columns of those days
+    :return: dataframe indexed by run date and time
+    """
+    with instrument.stage(f'feature {spec.name}'):
+        runs = np.arange(1, len(dates))
+        leads = np.asarray(spec.leads)[None, :]
+        reference_runs = runs if spec.same_run else np.maximum(reference[runs], 0)
+        reference_leads = leads if spec.same_run else leads + offset[runs, None]
+        every = not partial or spec.aggregation != 'each'
+
+        cur, cur_ok = take(forecasts[spec.model], runs, leads, every)
+        ref, ref_ok = take(forecasts[spec.reference], reference_runs, reference_leads, every)
+        mask = cur_ok & ref_ok
+        if not every:
+            cur = np.where(mask, cur, np.nan)
+            mask = mask.any(axis=1)
+        if not spec.same_run:
+            mask &= reference[runs] >= 0
+        if spec.min_lengths is not None:
+            mask &= ((forecasts[spec.model][1][runs] >= spec.min_lengths[0])
+                     & (forecasts[spec.reference][1][reference_runs] >= spec.min_lengths[1]))
+        instrument.rows(f'feature {spec.name}', mask.sum(), len(mask) - mask.sum())
+
+        if spec.aggregation == 'each':
+            return feature_frame(dates, runs, cur - ref, mask, feature_columns(spec))
+        aggregate = AGGREGATIONS[spec.aggregation]
+        values = aggregate(cur, axis=1) - aggregate(ref, axis=1)
+        return feature_frame(dates, runs, values[:, None], mask, feature_columns(spec))
+
+
+def build_features(ecmwf_sorted_files, ecmwf_eps_sorted_files, gfs_ens_bc_sorted_files, cmc_ens_sorted_files,
+                   specs, cache=None, workers=1, cycles=CYCLES):
+    """
+    compute a list of FeatureSpecs in one pass, every file is read once whatever the number of specs
+    e.g. to sweep lead windows:
+        specs = [FeatureSpec(f'gfs({start + 1},{end})', 'gfs-ens-bc', 'ecmwf-eps', range(start, end), 'sum')
+                 for start in range(6, 10) for end in range(12, 16)]
+        features = build_features(*sort_files(), specs)
+    :param specs: list of FeatureSpec
+    :param cache: ForecastCache to read the files through
+    :param workers: number of processes to parse the files with
+    :param cycles: init hours the runs were aligned with
+    :return: dataframe with the columns of every spec, nan where a run is missing lead days
+    """
+    runs = load_runs(ecmwf_sorted_files, ecmwf_eps_sorted_files, gfs_ens_bc_sorted_files, cmc_ens_sorted_files,
+                     cache, workers, cycles)
+    return pd.concat([compute_feature(spec, *runs) for spec in specs], axis=1, sort=True)
+
+
+@instrument.timed('build_master_df')
+def build_master_df(ecmwf_sorted_files, ecmwf_eps_sorted_files, gfs_ens_bc_sorted_files, cmc_ens_sorted_files,
+                    cache=None, workers=1, cycles=CYCLES):
+    """
+    build the feature rows for a set of aligned runs, each row needs the runs before it, see history_runs
+    :param cache: ForecastCache shared by the models, a new one is used for this build if not given
+    :param workers: number of processes to parse the files with
+    :param cycles: init hours the runs were aligned with
+    :return: master dataframe indexed by run date and time, with the columns and dtypes of SCHEMA
+    """
+    forecasts, dates, offset, reference = load_runs(ecmwf_sorted_files, ecmwf_eps_sorted_files,
+                                                    gfs_ens_bc_sorted_files, cmc_ens_sorted_files, cache, workers,
+                                                    cycles)
+    ecmwf_eps = forecasts['ecmwf-eps']
+    legacy = tuple(cycles) == CYCLES
+
+    # error of the reference run against its own reference run, dated by the current run
+    if legacy:
+        runs = np.arange(2, len(dates))
+        previous, before = runs - 1, runs - 2
+        # lead days the previous run is ahead of the run before it. the 00z/12z master_df has always taken this from
+        # the current run: one, unless the current run was made on the same day as the previous run
+        previous_offset = 1 - offset[runs]
+    else:
+        runs = np.flatnonzero((reference >= 0) & (reference[np.maximum(reference, 0)] >= 0))
+        previous = reference[runs]
+        before = reference[previous]
+        previous_offset = offset[previous]
+    days = np.arange(8, 14)[None, :]
+    with instrument.stage('feature error'):
+        cur, cur_ok = take(ecmwf_eps, previous, days - previous_offset[:, None])
+        prev, prev_ok = take(ecmwf_eps, before, days)
+        mask = cur_ok & prev_ok
+        instrument.rows('feature error', mask.sum(), len(mask) - mask.sum())
+        errors_df = feature_frame(dates, runs, cur - prev, mask, ERROR_COLUMNS)
+
+        errors_df['noon'] = errors_df.index.hour
+        errors_df['noon'] = errors_df['noon'].apply(lambda x: 1 if x >= 12 else 0)
+
+    features = ([compute_feature(spec, forecasts, dates, offset, reference) for spec in FEATURES]
+                + [errors_df]
+                + [compute_feature(spec, forecasts, dates, offset, reference, partial=not legacy) for spec in LABELS])
+    with instrument.stage('concat'):
+        master_df = pd.concat(features, axis=1, sort=True)
+        if legacy:
+            master_df.fillna(0, inplace=True)
         else:
-            offset = 0
-
-        errors = []
-        try:
-            for day in range(8, 14):
-                errors.append(ecmwf_eps_df.iloc[day - offset]['Value'] - prev_ecmwf_eps_df.iloc[day]['Value'])
-            new_row = pd.DataFrame([errors], columns=errors_df.columns, index=[date])
-            errors_df = pd.concat([errors_df, new_row])
-        except IndexError:
-            #print(f"error on {date}")
-            passed_rows.append(i)
-
-    errors_df['noon'] = errors_df.index.hour
-    errors_df['noon'] = errors_df['noon'].apply(lambda x: 1 if x == 12 else 0)
-
-    master_df = pd.concat(
-        [gfs_ens_bc_change_df, cmc_ens_change_df,
-         ecmwf_change_df, day_8_error, errors_df, ecmwf_eps_change_df], axis=1)
-    master_df.fillna(0, inplace=True)
-
-    master_df.to_pickle(f'master_df_{degree_days}.pkl')
+            # the ecmwf-eps 06z and 18z runs stop a lead day or two short of the last labels, those are left nan
+            # for AutoGluon to skip rather than filled with zeros, and the rows without any label are dropped
+            labels = [column for spec in LABELS for column in feature_columns(spec)]
+            master_df = master_df.dropna(subset=labels, how='all')
+            master_df.fillna({column: 0 for column in master_df.columns if column not in labels}, inplace=True)
+        # computed in float64 and stored as float32, half the memory and nothing for AutoGluon to infer
+        master_df = master_df.astype(SCHEMA)
+    instrument.rows('build_master_df', len(master_df))
+
+    return master_df
+
+
+def ProcessRawData(path="RawData", degree_days='gw_hdd', incremental=False, cache=None, workers=1, catalog=None,
+                   cycles=CYCLES):
+    """
+    build master_df_{degree_days}.pkl from the raw forecast files
+    :param path: directory holding the RawData csv files
+    :param degree_days: region, e.g. gw_hdd
+    :param incremental: only build rows for runs that are not in the manifest of the existing master_df and append
+        them, falls back to a full rebuild when there is no master_df or manifest yet
+    :param cache: ForecastCache to keep parsed files between calls, `cache.stats()` reports its hits and misses
+    :param workers: number of processes to parse the files with, the result does not depend on it
+    :param catalog: RunCatalog of `path` to find and align the runs with instead of globbing
+    :param cycles: init hours to build rows for, ALL_CYCLES writes master_df_{degree_days}_00_06_12_18.pkl. its
+        06z and 18z rows have nan for the labels past the last lead day of their ecmwf-eps run
+    """
+    if cache is None:
+        cache = ForecastCache()
+    sorted_files = sort_files(path, degree_days, catalog, cycles)
+    write_master_df(sorted_files, degree_days, incremental, cache, workers, cycles)
+
+
+def ProcessAllRawData(path="RawData", regions=REGIONS, incremental=False, cache=None, workers=1, catalog=None,
+                      cycles=CYCLES):
+    """
+    ProcessRawData for every region at once: `path` is listed once, the files of all regions are parsed in the same
+    pass and each master_df_{degree_days}.pkl is identical to the one ProcessRawData writes
+    :param regions: regions to build
+    the other parameters are the same as ProcessRawData
+    """
+    if cache is None:
+        # room for every file of every region, the regions don't share files
+        cache = ForecastCache(max_bytes=len(regions) * 256 * 2 ** 20)
+    all_sorted_files = sort_all_files(path, regions, catalog, cycles)
+    if not incremental:
+        with instrument.stage('parse'):
+            cache.prefetch([file for sorted_files in all_sorted_files.values() for files in sorted_files
+                            for file in files], workers)
+    for degree_days, sorted_files in all_sorted_files.items():
+        write_master_df(sorted_files, degree_days, incremental, cache, workers, cycles)
+
+
+def write_master_df(sorted_files, degree_days, incremental, cache, workers, cycles):
+    """
+    build and write the master_df of one region from its aligned files, see ProcessRawData
+    :param sorted_files: output of sort_files
+    """
+    name = f'master_df_{degree_days}' if tuple(cycles) == CYCLES else f'master_df_{degree_days}_{"_".join(cycles)}'
+    master_file = f'{name}.pkl'
+    manifest_file = f'{name}.manifest.json'
+
+    runs = [extract_date_time(filename) for filename in sorted_files[1]]
+
+    first_date = None
+    processed_runs = None
+    if incremental and os.path.exists(master_file) and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            processed_runs = set(tuple(run) for run in json.load(f))
+        if not processed_runs.issubset(runs):
+            # runs have disappeared since the last build, the stored rows can't be trusted
+            processed_runs = None
+
+    if processed_runs is None:
+        master_df = build_master_df(*sorted_files, cache=cache, workers=workers, cycles=cycles)
+    else:
+        new_runs = [i for i, run in enumerate(runs) if run not in processed_runs]
+        if not new_runs:
+            print(f'{master_file} is up to date')
+            return
+        # every row after the first new run can change, and each row needs the runs before it
+        first_new = new_runs[0]
+        start = max(first_new - history_runs(cycles) + 1, 0)
+        new_master_df = build_master_df(*(files[start:] for files in sorted_files), cache=cache,
+                                        workers=workers, cycles=cycles)
+        first_date = get_date(None, sorted_files[1][first_new])
+        new_master_df = new_master_df[new_master_df.index >= first_date]
+
+        with instrument.stage('read pickle'):
+            master_df = pd.read_pickle(master_file)
+        master_df = pd.concat([check_schema(master_df[master_df.index < first_date], SCHEMA), new_master_df])
+        print(f'appended {len(new_runs)} runs to {master_file}')
+
+    with instrument.stage('pickle'):
+        master_df.to_pickle(master_file)
+    if HAVE_PARQUET:
+        with instrument.stage('parquet'):
+            directory = partition_directory(degree_days, name)
+            # an incremental build only rewrites the months it appended to
+            write_partitions(master_df, directory, since=first_date if os.path.isdir(directory) else None)
+    with open(manifest_file, 'w') as f:
+        json.dump(runs, f)
 
 
 if __name__ == '__main__':
-    ProcessRawData()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--report', help='record the time and memory of every stage of the build into this json file')
+    args = parser.parse_args()
+
+    if args.report is None:
+        ProcessAllRawData()
+    else:
+        with instrument.recording() as recorder:
+            ProcessAllRawData()
+        recorder.save(args.report)
+        print(recorder.summary())
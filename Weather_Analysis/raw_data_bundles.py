@@ -0,0 +1,74 @@
+"""
+pack RawData into one compressed zip bundle per month
+
+a few dozen bundles sync, back up and sit on shared volumes far better than ~100k tiny csv files. files go into the
+bundle of the month of their init date, RawData_bundles/YYYY-MM.zip, and bundles.json lists the members of every
+bundle. process_raw_data reads the bundles in place: point it at the bundle directory instead of RawData, e.g.
+    ProcessRawData(path='RawData_bundles')
+and each file is read straight out of its zip through the zip's central directory, nothing is extracted.
+
+pack or update the bundles with:
+    python raw_data_bundles.py
+packing again only adds the files that landed since the last run.
+"""
+import json
+import os
+import zipfile
+
+BUNDLE_DIR = 'RawData_bundles'
+INDEX_FILE = 'bundles.json'
+
+
+def bundle_month(filename):
+    """
+    month of the bundle a file goes into
+    :param filename: name in the form model.YYYYMMDD.HH.region.csv
+    :return: YYYY-MM
+    """
+    date = os.path.basename(filename).split('.')[1]
+    return f'{date[:4]}-{date[4:6]}'
+
+
+def pack(path='RawData', bundle_dir=BUNDLE_DIR, compression=zipfile.ZIP_DEFLATED):
+    """
+    add every csv file in `path` to the bundle of its month, files already in a bundle are skipped
+    :param path: directory holding the RawData csv files
+    :param bundle_dir: directory of the bundles, created if needed
+    :param compression: zipfile compression method
+    :return: number of files added
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    index_file = os.path.join(bundle_dir, INDEX_FILE)
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+
+    new_files = {}
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.csv') and filename.count('.') == 4:
+            new_files.setdefault(bundle_month(filename), []).append(filename)
+
+    n_added = 0
+    for month, filenames in sorted(new_files.items()):
+        packed = set(index.get(month, []))
+        filenames = [filename for filename in filenames if filename not in packed]
+        if not filenames:
+            continue
+        with zipfile.ZipFile(os.path.join(bundle_dir, f'{month}.zip'), 'a', compression=compression) as bundle:
+            # the members of a run interrupted before writing the index are in the zip but not in the index
+            packed = set(bundle.namelist())
+            filenames = [filename for filename in filenames if filename not in packed]
+            for filename in filenames:
+                bundle.write(os.path.join(path, filename), filename)
+        index[month] = sorted(packed.union(filenames))
+        n_added += len(filenames)
+
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file + '.tmp', index_file)
+    return n_added
+
+
+if __name__ == '__main__':
+    print(f'added {pack()} files to {BUNDLE_DIR}')
@@ -0,0 +1,226 @@
+"""
+pack the RawData forecast archive into a single columnar store
+
+every file in RawData is a tiny Date,Value,Flag csv named model.YYYYMMDD.HH.region.csv. reading ~100k of
+them one at a time costs minutes of csv parsing and inode lookups, so `ingest` packs them once into a single
+.npz file keyed by model, init date, cycle, region and lead day. `glob` and `read_csv` are drop in replacements
+for `glob.glob` and `pd.read_csv` that are served from the store and fall back to the loose files when no store
+has been built or a file is not in it. once files have landed or been removed after the last ingest (the directory
+mtime moved on), `glob` lists the directory again and merges it with the store, ingest again to catch up.
+
+build the store with:
+    python raw_data_store.py
+"""
+import fnmatch
+import glob as _glob
+import os
+
+import numpy as np
+import pandas as pd
+
+STORE_FILE = 'RawData_store.npz'
+FLAG_COLUMN = 'Flag (0=obs 1=fcst 2=norm)'
+
+
+class RawDataStore:
+    """ columnar copy of the RawData archive.
+
+        one entry per file, stored as flat arrays:
+            model, region : int8 codes into `models` / `regions`
+            date          : int32 init date as YYYYMMDD
+            cycle         : int8 init hour
+            offsets       : int64, rows of file i are offsets[i]:offsets[i + 1] of the row arrays
+        and one entry per csv row (the lead day is the position of the row inside its file):
+            day           : int32 valid date as days since 1970-01-01
+            value         : float64, kept at full precision so results match parsing the csv files
+            flag          : int8 (0=obs 1=fcst 2=norm)
+    """
+
+    def __init__(self, store_file=STORE_FILE):
+        with np.load(store_file) as data:
+            self.path = str(data['path'])
+            self.models = data['models'].tolist()
+            self.regions = data['regions'].tolist()
+            self.model = data['model']
+            self.date = data['date']
+            self.cycle = data['cycle']
+            self.region = data['region']
+            self.offsets = data['offsets']
+            self.day = data['day']
+            self.value = data['value']
+            self.flag = data['flag']
+            # mtime of the directory when it was listed, stores from before it was recorded are always stale
+            self.listed_mtime = int(data['listed_mtime']) if 'listed_mtime' in data.files else None
+        self.filenames = [f'{self.models[m]}.{d}.{c:02d}.{self.regions[r]}.csv'
+                          for m, d, c, r in zip(self.model, self.date, self.cycle, self.region)]
+        self.index = {filename: i for i, filename in enumerate(self.filenames)}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def is_stale(self):
+        """ whether files landed in or were removed from the directory since it was ingested """
+        try:
+            return self.listed_mtime is None or os.stat(self.path).st_mtime_ns != self.listed_mtime
+        except OSError:
+            # the loose files were removed, the store is all there is
+            return False
+
+    def glob(self, pattern):
+        """
+        match a glob pattern against the files in the store, and against the directory too if the store is stale
+        :param pattern: pattern in the form used with glob.glob, e.g. RawData/ecmwf.*.[01][02].gw_hdd.csv
+        :return: list of matching paths
+        """
+        directory, name_pattern = os.path.split(pattern)
+        if os.path.normpath(directory) != os.path.normpath(self.path):
+            return _glob.glob(pattern)
+        files = [os.path.join(directory, filename) for filename in fnmatch.filter(self.filenames, name_pattern)]
+        if self.is_stale():
+            return sorted(set(files).union(_glob.glob(pattern)))
+        return files
+
+    def get_values(self, filename):
+        """
+        get the raw arrays of a single file
+        :param filename: path or name of the file
+        :return: (day, value, flag) arrays, or None if the file is not in the store
+        """
+        directory, name = os.path.split(filename)
+        if directory and os.path.normpath(directory) != os.path.normpath(self.path):
+            return None
+        i = self.index.get(name)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.day[start:end], self.value[start:end], self.flag[start:end]
+
+    def read_csv(self, filename):
+        """
+        read a single file from the store, falling back to the file on disk if it is not in the store
+        :param filename: path of the file
+        :return: dataframe with the same columns as pd.read_csv(filename)
+        """
+        values = self.get_values(filename)
+        if values is None or len(values[0]) == 0:
+            return pd.read_csv(filename)
+        day, value, flag = values
+        return pd.DataFrame({'Date': np.datetime_as_string(day.astype('datetime64[D]')),
+                             'Value': value,
+                             FLAG_COLUMN: flag.astype(np.int64)})
+
+
+def parse_filename(filename):
+    """
+    split a RawData filename into its key
+    :param filename: name in the form model.YYYYMMDD.HH.region.csv
+    :return: (model, date, cycle, region)
+    """
+    parts = os.path.basename(filename).split('.')
+    return parts[0], int(parts[1]), int(parts[2]), parts[3]
+
+
+def parse_csv(filename):
+    """
+    parse a single file with the forecast file parser in process_raw_data
+    :param filename: path of the file
+    :return: (day, value, flag) arrays
+    """
+    # imported here as process_raw_data reads through this module
+    from process_raw_data import parse_forecast_file
+    day, value, flag = parse_forecast_file(filename, dtype=np.float64)
+    return day.astype(np.int32), value, flag
+
+
+def ingest(path='RawData', store_file=STORE_FILE):
+    """
+    pack every csv file in `path` into a single store file
+    :param path: directory holding the RawData csv files
+    :param store_file: where to write the store
+    :return: number of files packed
+    """
+    # taken before listing, a file landing while the store is built makes it stale rather than being missed
+    listed_mtime = os.stat(path).st_mtime_ns
+    filenames = sorted(filename for filename in os.listdir(path)
+                       if filename.endswith('.csv') and filename.count('.') == 4)
+    keys = [parse_filename(filename) for filename in filenames]
+    models = sorted(set(key[0] for key in keys))
+    regions = sorted(set(key[3] for key in keys))
+
+    days, values, flags = [], [], []
+    offsets = np.zeros(len(filenames) + 1, dtype=np.int64)
+    for i, filename in enumerate(filenames):
+        try:
+            day, value, flag = parse_csv(os.path.join(path, filename))
+        except pd.errors.EmptyDataError:
+            # keep an empty entry so the file is still listed, reading it falls back to the file on disk
+            offsets[i + 1] = offsets[i]
+            continue
+        days.append(day)
+        values.append(value)
+        flags.append(flag)
+        offsets[i + 1] = offsets[i] + len(value)
+
+    np.savez(store_file,
+             path=np.array(path),
+             listed_mtime=np.array(listed_mtime, dtype=np.int64),
+             models=np.array(models),
+             regions=np.array(regions),
+             model=np.array([models.index(key[0]) for key in keys], dtype=np.int8),
+             date=np.array([key[1] for key in keys], dtype=np.int32),
+             cycle=np.array([key[2] for key in keys], dtype=np.int8),
+             region=np.array([regions.index(key[3]) for key in keys], dtype=np.int8),
+             offsets=offsets,
+             day=np.concatenate(days) if days else np.zeros(0, dtype=np.int32),
+             value=np.concatenate(values) if values else np.zeros(0, dtype=np.float64),
+             flag=np.concatenate(flags) if flags else np.zeros(0, dtype=np.int8))
+    return len(filenames)
+
+
+_stores = {}
+
+
+def get_store(store_file=STORE_FILE):
+    """
+    load the store once per process
+    :param store_file: store written by `ingest`
+    :return: RawDataStore, or None if the store has not been built
+    """
+    if store_file not in _stores:
+        _stores[store_file] = RawDataStore(store_file) if os.path.exists(store_file) else None
+    return _stores[store_file]
+
+
+def glob(pattern, store_file=STORE_FILE):
+    """ drop in replacement for glob.glob that lists the files in the store when it exists """
+    store = get_store(store_file)
+    if store is None:
+        return _glob.glob(pattern)
+    return store.glob(pattern)
+
+
+def read_csv(filename, store_file=STORE_FILE):
+    """ drop in replacement for pd.read_csv that reads from the store when it exists """
+    store = get_store(store_file)
+    if store is None:
+        return pd.read_csv(filename)
+    return store.read_csv(filename)
+
+
+def read_values(filename, store_file=STORE_FILE):
+    """
+    read the rows of a single file as arrays, from the store when it exists
+    :param filename: path of the file
+    :param store_file: store written by `ingest`
+    :return: (day, value, flag) arrays
+    """
+    store = get_store(store_file)
+    values = store.get_values(filename) if store is not None else None
+    if values is None or len(values[0]) == 0:
+        return parse_csv(filename)
+    return values
+
+
+if __name__ == '__main__':
+    n_files = ingest()
+    print(f'packed {n_files} files into {STORE_FILE}')
@@ -0,0 +1,143 @@
+"""
+persistent catalog of the runs in RawData
+
+one row per (model, date, cycle, region) in a small sqlite database, built once from a directory listing and
+updated as new files land. lining up the runs that every model shares is a single indexed join, and questions
+like "which runs are missing for model X" are answered without touching the filesystem.
+
+build or update the catalog with:
+    python run_catalog.py
+"""
+import os
+import sqlite3
+
+CATALOG_FILE = 'RawData_catalog.sqlite'
+MODELS = ['ecmwf', 'ecmwf-eps', 'gfs-ens-bc', 'cmc-ens']
+# the earliest runs of each model that ProcessRawData has always skipped
+SKIP_RUNS = {'ecmwf': 3, 'ecmwf-eps': 2, 'gfs-ens-bc': 2, 'cmc-ens': 2}
+
+
+class RunCatalog:
+    """ sqlite catalog of the RawData files.
+
+        :param path: directory holding the RawData csv files
+        :param catalog_file: sqlite database, created if it does not exist
+    """
+
+    def __init__(self, path='RawData', catalog_file=CATALOG_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(catalog_file)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                model TEXT NOT NULL,
+                region TEXT NOT NULL,
+                date TEXT NOT NULL,
+                cycle TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                PRIMARY KEY (model, region, date, cycle)
+            ) WITHOUT ROWID""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS runs_by_time ON runs (region, date, cycle)")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, filenames):
+        """
+        add files to the catalog, e.g. as they land
+        :param filenames: names or paths in the form model.YYYYMMDD.HH.region.csv
+        :return: number of new runs
+        """
+        rows = []
+        for filename in filenames:
+            filename = os.path.basename(filename)
+            parts = filename.split('.')
+            if len(parts) == 5 and parts[4] == 'csv':
+                rows.append((parts[0], parts[3], parts[1], parts[2], filename))
+        before = self.connection.total_changes
+        self.connection.executemany("INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        return self.connection.total_changes - before
+
+    def update(self):
+        """
+        add every file in `path` that is not in the catalog yet, a single directory listing
+        :return: number of new runs
+        """
+        return self.add(os.listdir(self.path))
+
+    def sorted_files(self, model, degree_days, cycles=('00', '12')):
+        """
+        list the files of one model sorted by date and time, like a sorted glob
+        :param model: e.g. ecmwf-eps
+        :param degree_days: region, e.g. gw_hdd
+        :param cycles: init hours to include
+        :return: list of paths
+        """
+        rows = self.connection.execute(f"""
+            SELECT filename FROM runs
+            WHERE model = ? AND region = ? AND cycle IN ({', '.join('?' * len(cycles))})
+            ORDER BY date, cycle""", (model, degree_days, *cycles))
+        return [os.path.join(self.path, filename) for filename, in rows]
+
+    def aligned_files(self, degree_days, cycles=('00', '12')):
+        """
+        the runs of ecmwf, ecmwf-eps, gfs-ens-bc and cmc-ens that all four models share, after skipping the earliest
+        runs of each model the same way ProcessRawData always has. ecmwf and cmc-ens only run at 00z and 12z, their
+        run from six hours earlier is used with the 06z and 18z runs of the other two
+        :param degree_days: region, e.g. gw_hdd
+        :param cycles: init hours to include
+        :return: (ecmwf, ecmwf-eps, gfs-ens-bc, cmc-ens) lists of files, sorted by date and time and aligned by index
+        """
+        in_cycles = ', '.join('?' * len(cycles))
+        # the first run kept for each model, runs are compared as (date, cycle) row values
+        first_runs = []
+        for model in MODELS:
+            first_run = self.connection.execute(f"""
+                SELECT date, cycle FROM runs
+                WHERE model = ? AND region = ? AND cycle IN ({in_cycles})
+                ORDER BY date, cycle LIMIT 1 OFFSET ?""", (model, degree_days, *cycles, SKIP_RUNS[model])).fetchone()
+            if first_run is None:
+                return [], [], [], []
+            first_runs.extend(first_run)
+
+        rows = self.connection.execute(f"""
+            SELECT e.filename, p.filename, g.filename, c.filename
+            FROM runs p
+            JOIN runs g ON g.model = 'gfs-ens-bc' AND g.region = p.region AND g.date = p.date AND g.cycle = p.cycle
+            JOIN runs e ON e.model = 'ecmwf' AND e.region = p.region AND e.date = p.date
+                       AND e.cycle = printf('%02d', CAST(p.cycle AS INTEGER) / 12 * 12)
+            JOIN runs c ON c.model = 'cmc-ens' AND c.region = p.region AND c.date = p.date AND c.cycle = e.cycle
+            WHERE p.model = 'ecmwf-eps' AND p.region = ? AND p.cycle IN ({in_cycles}) AND e.cycle IN ({in_cycles})
+              AND (e.date, e.cycle) >= (?, ?) AND (p.date, p.cycle) >= (?, ?)
+              AND (g.date, g.cycle) >= (?, ?) AND (c.date, c.cycle) >= (?, ?)
+            ORDER BY p.date, p.cycle""", (degree_days, *cycles, *cycles, *first_runs))
+        files = ([], [], [], [])
+        for row in rows:
+            for model_files, filename in zip(files, row):
+                model_files.append(os.path.join(self.path, filename))
+        return files
+
+    def missing_runs(self, model, degree_days, cycles=('00', '12')):
+        """
+        runs that another model has but `model` does not
+        :param model: e.g. cmc-ens
+        :param degree_days: region, e.g. gw_hdd
+        :param cycles: init hours to include
+        :return: sorted list of (date, cycle)
+        """
+        return self.connection.execute(f"""
+            SELECT DISTINCT date, cycle FROM runs
+            WHERE region = ? AND model != ? AND cycle IN ({', '.join('?' * len(cycles))})
+              AND model IN ({', '.join('?' * len(MODELS))})
+            EXCEPT
+            SELECT date, cycle FROM runs WHERE region = ? AND model = ?
+            ORDER BY date, cycle""", (degree_days, model, *cycles, *MODELS, degree_days, model)).fetchall()
+
+
+if __name__ == '__main__':
+    catalog = RunCatalog()
+    print(f'added {catalog.update()} runs, {len(catalog)} runs in {CATALOG_FILE}')
@@ -0,0 +1,61 @@
+"""
+write a synthetic RawData archive for tests and benchmarks
+
+files are named model.YYYYMMDD.HH.region.csv and laid out like the real ones: a week of observations (flag 0),
+the forecast rows (flag 1) starting on the init date for 00z/06z runs and the day after for 12z/18z runs, then a
+week of normals (flag 2). runs can be left out and files can be cut short, which exercises the paths where a run
+has no counterpart in another model or too few lead days for a feature.
+"""
+import os
+import random
+from datetime import date, timedelta
+
+HEADER = 'Date,Value,"Flag (0=obs 1=fcst 2=norm)"\n'
+# number of forecast rows of each model in the real archive
+FORECAST_DAYS = {'ecmwf': 10, 'ecmwf-eps': 15, 'gfs-ens-bc': 16, 'cmc-ens': 16}
+# the ecmwf-eps 06z and 18z runs stop after a few days, the normals follow them as in every file
+CYCLE_FORECAST_DAYS = {('ecmwf-eps', '06'): 6, ('ecmwf-eps', '18'): 5}
+
+
+def generate_raw_data(path, n_runs=100, models=('ecmwf', 'ecmwf-eps', 'gfs-ens-bc', 'cmc-ens'),
+                      regions=('gw_hdd',), cycles=('00', '12'), missing_rate=0.0, short_rate=0.0,
+                      start=date(2018, 7, 9), seed=0):
+    """
+    write n_runs runs of every model and region into `path`
+    :param path: directory to write into, created if needed
+    :param n_runs: number of init times, consecutive cycles starting at `start`
+    :param models: models to write, with FORECAST_DAYS forecast rows each or CYCLE_FORECAST_DAYS for their cycle
+    :param regions: regions to write
+    :param cycles: init hours of each day
+    :param missing_rate: probability that a file is left out
+    :param short_rate: probability that a file only has 7 forecast rows and nothing after them
+    :param start: first init date
+    :param seed: seed of the values, missing and short files
+    :return: number of files written
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = random.Random(seed)
+    n_files = 0
+    for run in range(n_runs):
+        init_date = start + timedelta(days=run // len(cycles))
+        cycle = cycles[run % len(cycles)]
+        first_day = init_date + timedelta(days=0 if int(cycle) < 12 else 1)
+        for region in regions:
+            for model in models:
+                if rng.random() < missing_rate:
+                    continue
+                n_forecast = CYCLE_FORECAST_DAYS.get((model, cycle), FORECAST_DAYS.get(model, 15))
+                short = rng.random() < short_rate
+                rows = [HEADER]
+                if short:
+                    for day in range(7):
+                        rows.append(f'{first_day + timedelta(days=day)},{rng.uniform(0, 30):.3f},1\n')
+                else:
+                    for day in range(-7, n_forecast + 7):
+                        flag = 0 if day < 0 else 1 if day < n_forecast else 2
+                        rows.append(f'{first_day + timedelta(days=day)},{rng.uniform(0, 30):.3f},{flag}\n')
+                filename = f'{model}.{init_date:%Y%m%d}.{cycle}.{region}.csv'
+                with open(os.path.join(path, filename), 'w') as f:
+                    f.writelines(rows)
+                n_files += 1
+    return n_files
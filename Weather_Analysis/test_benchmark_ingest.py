@@ -0,0 +1,64 @@
+"""
+benchmarks of each stage of the master_df build on synthetic RawData archives, run with pytest-benchmark:
+    python -m pytest Weather_Analysis/test_benchmark_ingest.py --benchmark-autosave
+    python -m pytest Weather_Analysis/test_benchmark_ingest.py --run-slow    # the 1M file archive as well
+--benchmark-autosave keeps every run under .benchmarks tagged with the commit, --benchmark-compare compares them.
+"""
+import os
+
+import pytest
+
+from process_raw_data import MODELS, ForecastCache, align_files, build_master_df, glob_files, load_forecasts
+from synthetic_raw_data import generate_raw_data
+
+pytest.importorskip('pytest_benchmark')
+
+SIZES = [10_000, 100_000, pytest.param(1_000_000, marks=pytest.mark.slow)]
+
+
+@pytest.fixture(scope='module', params=SIZES, ids=lambda size: f'{size}_files')
+def archive(request, tmp_path_factory):
+    """ synthetic archive of about `size` files spread over the four models of one region """
+    path = str(tmp_path_factory.mktemp('archive') / 'RawData')
+    generate_raw_data(path, n_runs=request.param // len(MODELS), missing_rate=0.01, short_rate=0.01)
+    return path
+
+
+def list_files(path):
+    return {model: glob_files(path + f'/{model}.*.*.gw_hdd.csv') for model in MODELS}
+
+
+def parse(sorted_files, cache):
+    for files in sorted_files:
+        load_forecasts(files, cache)
+
+
+def test_glob(benchmark, archive):
+    files = benchmark(list_files, archive)
+    assert all(files.values())
+
+
+def test_align(benchmark, archive):
+    files = list_files(archive)
+    sorted_files = benchmark(align_files, files)
+    assert len(sorted_files[1]) > 0
+
+
+def test_parse(benchmark, archive):
+    sorted_files = align_files(list_files(archive))
+    # a cold cache every round, otherwise the later rounds only time cache hits
+    benchmark.pedantic(parse, setup=lambda: ((sorted_files, ForecastCache(max_bytes=2 ** 40)), {}), rounds=3)
+
+
+def test_features(benchmark, archive):
+    sorted_files = align_files(list_files(archive))
+    cache = ForecastCache(max_bytes=2 ** 40)
+    parse(sorted_files, cache)
+    master_df = benchmark.pedantic(build_master_df, args=sorted_files, kwargs={'cache': cache}, rounds=3)
+    assert len(master_df) > 0
+
+
+def test_pickle(benchmark, archive, tmp_path):
+    sorted_files = align_files(list_files(archive))
+    master_df = build_master_df(*sorted_files)
+    benchmark(master_df.to_pickle, os.path.join(tmp_path, 'master_df.pkl'))
@@ -0,0 +1,196 @@
+"""
+tests of the master_df build on small synthetic RawData archives, run with:
+    python -m pytest Weather_Analysis
+"""
+import glob
+import os
+from datetime import datetime, time
+
+import pandas as pd
+import pytest
+
+import process_raw_data
+import raw_data_bundles
+import raw_data_store
+from process_raw_data import ALL_CYCLES, SCHEMA, ProcessRawData, build_master_df, glob_files, read_forecast, sort_files
+from synthetic_raw_data import generate_raw_data
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ empty working directory, the build writes its master_df, manifest and store there """
+    monkeypatch.chdir(tmp_path)
+    # the store and bundles are loaded once per process and keyed by relative paths
+    monkeypatch.setattr(raw_data_store, '_stores', {})
+    monkeypatch.setattr(process_raw_data, '_bundles', {})
+    return tmp_path
+
+
+def test_incremental_with_store_picks_up_new_files(workdir):
+    generate_raw_data('RawData', n_runs=20)
+    raw_data_store.ingest('RawData')
+    ProcessRawData(incremental=True)
+    first = pd.read_pickle('master_df_gw_hdd.pkl')
+
+    # the same seed rewrites the first 20 runs unchanged and adds 10 after them, none of them in the store
+    generate_raw_data('RawData', n_runs=30)
+    ProcessRawData(incremental=True)
+    incremental = pd.read_pickle('master_df_gw_hdd.pkl')
+    assert len(incremental) > len(first)
+
+    raw_data_store._stores.clear()
+    raw_data_store.ingest('RawData')
+    ProcessRawData()
+    pd.testing.assert_frame_equal(incremental, pd.read_pickle('master_df_gw_hdd.pkl'))
+
+
+def test_bundles_pick_up_packed_months(workdir):
+    generate_raw_data('RawData', n_runs=20)
+    raw_data_bundles.pack()
+    first = glob_files('RawData_bundles/ecmwf-eps.*.*.gw_hdd.csv')
+    read_forecast(first[-1])
+
+    # the runs of the rest of july and of august are packed while the bundles stay loaded
+    generate_raw_data('RawData', n_runs=80)
+    raw_data_bundles.pack()
+    files = glob_files('RawData_bundles/ecmwf-eps.*.*.gw_hdd.csv')
+    assert len(files) == 80
+    for file in files:
+        loose = os.path.join('RawData', os.path.basename(file))
+        assert read_forecast(file) == pytest.approx(read_forecast(loose))
+
+
+def reference_master_df(path='RawData', degree_days='gw_hdd'):
+    """ master_df of the original per row loops of ProcessRawData, the five change loops folded into one helper """
+
+    def extract_date_time(filename):
+        parts = filename.split('.')
+        return parts[1], parts[2]
+
+    def get_date(file):
+        date = datetime.strptime(str(file.split('.')[1]), '%Y%m%d')
+        return datetime.combine(date.date(), time(int(file.split('.')[2]), 0))
+
+    def read_forecast(file):
+        df = pd.read_csv(file)
+        return df[df[df.columns[2]] >= 1]
+
+    def sorted_files(model, skip):
+        files = glob.glob(path + f'/{model}.*.[01][02].{degree_days}.csv')
+        return sorted(files, key=lambda x: (x.split('.')[1], x.split('.')[2]))[skip:]
+
+    ecmwf_sorted_files = sorted_files('ecmwf', 3)
+    ecmwf_eps_sorted_files = sorted_files('ecmwf-eps', 2)
+    gfs_ens_bc_sorted_files = sorted_files('gfs-ens-bc', 2)
+    cmc_ens_sorted_files = sorted_files('cmc-ens', 2)
+    for _ in range(2):
+        set1 = set(extract_date_time(filename) for filename in ecmwf_sorted_files)
+        set2 = set(extract_date_time(filename) for filename in ecmwf_eps_sorted_files)
+        ecmwf_sorted_files = [filename for filename in ecmwf_sorted_files if extract_date_time(filename) in set2]
+        ecmwf_eps_sorted_files = [filename for filename in ecmwf_eps_sorted_files if
+                                  extract_date_time(filename) in set1]
+        cmc_ens_sorted_files = [filename for filename in cmc_ens_sorted_files if extract_date_time(filename) in set1]
+        master_set = set(extract_date_time(filename) for filename in cmc_ens_sorted_files)
+        gfs_ens_bc_sorted_files = [filename for filename in gfs_ens_bc_sorted_files if
+                                   extract_date_time(filename) in master_set]
+        master_set = set(extract_date_time(filename) for filename in gfs_ens_bc_sorted_files)
+        ecmwf_sorted_files = [filename for filename in ecmwf_sorted_files if extract_date_time(filename) in master_set]
+        ecmwf_eps_sorted_files = [filename for filename in ecmwf_eps_sorted_files if
+                                  extract_date_time(filename) in master_set]
+        gfs_ens_bc_sorted_files = [filename for filename in gfs_ens_bc_sorted_files if
+                                   extract_date_time(filename) in master_set]
+        cmc_ens_sorted_files = [filename for filename in cmc_ens_sorted_files if
+                                extract_date_time(filename) in master_set]
+
+    def changes_df(columns, model_files, reference_files, days, offset_rule, min_rows=None):
+        """ one of the original loops, `offset_rule` is None for the same run or the shift of a same day run """
+        rows = {}
+        for i in range(1, len(model_files)):
+            model_df = read_forecast(model_files[i])
+            reference_df = read_forecast(reference_files[i if offset_rule is None else i - 1])
+            if min_rows is not None and (len(model_df) < min_rows[0] or len(reference_df) < min_rows[1]):
+                continue
+            date = get_date(model_files[i])
+            offset = 0
+            if offset_rule is not None:
+                same_day = str(date)[:10] == str(get_date(reference_files[i - 1]))[:10]
+                offset = 1 if same_day else 0
+            try:
+                rows[date] = [model_df.iloc[day]['Value'] - reference_df.iloc[day + offset]['Value'] for day in days]
+            except IndexError:
+                pass
+        return pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+
+    ecmwf_eps_change_df = changes_df([f'ecmwf-eps_{day + 1}' for day in range(8, 14)], ecmwf_eps_sorted_files,
+                                     ecmwf_eps_sorted_files, range(8, 14), 'previous')
+    ecmwf_change_df = changes_df(['ecmwf_diff_8', 'ecmwf_diff_9'], ecmwf_sorted_files, ecmwf_eps_sorted_files,
+                                 range(7, 9), 'previous', min_rows=(9, 10))
+    gfs_ens_bc_change_df = changes_df([f'gfs-ens-bc_{day + 1}' for day in range(8, 14)], gfs_ens_bc_sorted_files,
+                                      ecmwf_eps_sorted_files, range(8, 14), 'previous')
+    cmc_ens_change_df = changes_df([f'cmc-ens_{day + 1}' for day in range(8, 14)], cmc_ens_sorted_files,
+                                   gfs_ens_bc_sorted_files, range(8, 14), None)
+    day_8_error = changes_df(['day_8_error'], ecmwf_eps_sorted_files, ecmwf_eps_sorted_files, range(7, 8),
+                             'previous')
+
+    errors = {}
+    for i in range(2, len(ecmwf_eps_sorted_files)):
+        ecmwf_eps_df = read_forecast(ecmwf_eps_sorted_files[i - 1])
+        prev_ecmwf_eps_df = read_forecast(ecmwf_eps_sorted_files[i - 2])
+        date = get_date(ecmwf_eps_sorted_files[i])
+        offset = 1 if str(date)[:10] != str(get_date(ecmwf_eps_sorted_files[i - 1]))[:10] else 0
+        try:
+            errors[date] = [ecmwf_eps_df.iloc[day - offset]['Value'] - prev_ecmwf_eps_df.iloc[day]['Value']
+                            for day in range(8, 14)]
+        except IndexError:
+            pass
+    errors_df = pd.DataFrame.from_dict(errors, orient='index', columns=[f'error_{day + 1}' for day in range(8, 14)])
+    errors_df['noon'] = (errors_df.index.hour == 12).astype(int)
+
+    master_df = pd.concat([gfs_ens_bc_change_df, cmc_ens_change_df, ecmwf_change_df, day_8_error, errors_df,
+                           ecmwf_eps_change_df], axis=1, sort=True)
+    return master_df.fillna(0)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_build_master_df_matches_reference_loops(workdir, seed):
+    # short files lack the later lead days and missing files break the alignment, both drop rows
+    generate_raw_data('RawData', n_runs=80, missing_rate=0.05, short_rate=0.1, seed=seed)
+    expected = reference_master_df().astype(float).astype(SCHEMA)
+    master_df = build_master_df(*sort_files())
+    assert len(master_df) > 0
+    pd.testing.assert_frame_equal(master_df, expected, check_freq=False, check_names=False)
+
+
+def test_four_cycle_rows_compare_against_full_runs(workdir):
+    # like the real archive, the 06z and 18z ecmwf-eps runs have 13 and 12 rows from the first lead day on
+    generate_raw_data('RawData', n_runs=120, cycles=ALL_CYCLES)
+    master_df = build_master_df(*sort_files(cycles=ALL_CYCLES), cycles=ALL_CYCLES)
+    labels = [column for column in master_df.columns if column.startswith('ecmwf-eps_')]
+    gfs = [column for column in master_df.columns if column.startswith('gfs-ens-bc_')]
+    assert set(master_df.index.hour) == {0, 6, 12, 18}
+    assert not (master_df[labels] == 0).all(axis=1).any()
+    assert not (master_df[gfs] == 0).all(axis=1).any()
+    # only the labels past the end of a short run are missing, nothing else is
+    missing = master_df[labels].isna().groupby(master_df.index.hour).any()
+    assert missing.loc[[0, 12]].to_numpy().sum() == 0
+    assert missing.loc[6].tolist() == [False] * 5 + [True]
+    assert missing.loc[18].tolist() == [False] * 4 + [True] * 2
+    assert not master_df.drop(columns=labels).isna().any().any()
+
+    def forecast(model, run):
+        df = pd.read_csv(f'RawData/{model}.{run}.gw_hdd.csv')
+        return df[df[df.columns[2]] >= 1]['Value'].to_numpy()
+
+    # a 12z run is compared against the 00z run of the same day, a day ahead of it, skipping the short 06z run
+    date = master_df.index[(master_df.index.hour == 12)][5]
+    run, reference = f'{date:%Y%m%d}.12', f'{date:%Y%m%d}.00'
+    expected = forecast('ecmwf-eps', run)[8:14] - forecast('ecmwf-eps', reference)[9:15]
+    assert master_df.loc[date, labels].to_numpy() == pytest.approx(expected.astype('float32'))
+    expected = forecast('gfs-ens-bc', run)[8:14] - forecast('ecmwf-eps', reference)[9:15]
+    assert master_df.loc[date, gfs].to_numpy() == pytest.approx(expected.astype('float32'))
+
+    # a 06z run is compared against the 00z run of the same day, on the same dates
+    date = master_df.index[(master_df.index.hour == 6)][5]
+    run, reference = f'{date:%Y%m%d}.06', f'{date:%Y%m%d}.00'
+    expected = forecast('ecmwf-eps', run)[8:13] - forecast('ecmwf-eps', reference)[8:13]
+    assert master_df.loc[date, labels[:5]].to_numpy() == pytest.approx(expected.astype('float32'))
@@ -0,0 +1,180 @@
+"""
+watch RawData and predict each new run as soon as ecmwf, ecmwf-eps, gfs-ens-bc and cmc-ens have all landed
+
+the aligned runs and the parsed files of the latest runs stay in memory and the predictor is loaded once, so a new
+run costs a directory listing, parsing its four files and building a single feature row. each prediction is
+appended to predictions_{degree_days}.jsonl together with its latency, measured from the moment the last of the
+four files landed.
+
+files should be written atomically (written elsewhere and renamed into RawData), a run is picked up as soon as its
+last file shows up in the listing.
+
+run with:
+    python watch_raw_data.py gw_hdd
+"""
+import argparse
+import json
+import os
+import time
+
+from process_raw_data import (CYCLES, LABELS, ForecastCache, base_cycle, build_master_df, extract_date_time,
+                              feature_columns, get_date, history_runs, sort_files)
+from run_catalog import MODELS
+
+PREDICTIONS_FILE = 'predictions_{degree_days}.jsonl'
+
+
+class RunWatcher:
+    """ polls RawData for new runs and predicts each init time once every model has landed.
+
+        the directory is only listed when its mtime changes, so an idle poll costs a single stat.
+
+        :param predictor: fitted MultilabelPredictor, or anything with a predict(dataframe) method
+        :param path: directory holding the RawData csv files
+        :param degree_days: region, e.g. gw_hdd
+        :param predictions_file: jsonl file the predictions are appended to
+        :param poll_interval: seconds between two polls of the directory
+        :param catalog: RunCatalog of `path` to find the runs that are already there with instead of globbing
+        :param cycles: init hours to predict, the predictor must have been trained on a master_df of the same cycles
+    """
+
+    def __init__(self, predictor, path='RawData', degree_days='gw_hdd', predictions_file=None, poll_interval=0.1,
+                 catalog=None, cycles=CYCLES):
+        self.predictor = predictor
+        self.path = path
+        self.degree_days = degree_days
+        self.predictions_file = predictions_file or PREDICTIONS_FILE.format(degree_days=degree_days)
+        self.poll_interval = poll_interval
+        self.cycles = tuple(cycles)
+        self.label_columns = [column for spec in LABELS for column in feature_columns(spec)]
+
+        # runs already aligned in the same order as ProcessRawData, a new row needs the runs before it
+        self.sorted_files = [list(files) for files in sort_files(path, degree_days, catalog, cycles)]
+        self.history = history_runs(cycles)
+        self.last_run = extract_date_time(os.path.basename(self.sorted_files[1][-1])) if self.sorted_files[1] \
+            else ('', '00')
+        self.cache = ForecastCache()
+        self.cache.prefetch([file for files in self.sorted_files for file in files[1 - self.history:]])
+        # (model, date, cycle) -> file of everything that landed since the last aligned run, the ecmwf and cmc-ens
+        # run of the last aligned run can still be needed by the run six hours after it
+        self.landed = {}
+        if self.sorted_files[1]:
+            for model, files in zip(MODELS, self.sorted_files):
+                self.landed[(model, *extract_date_time(os.path.basename(files[-1])))] = files[-1]
+        self.mtime = None
+
+    def is_complete(self, run):
+        """ whether every model has landed for `run`, ecmwf and cmc-ens for its base_cycle run """
+        base_run = (run[0], base_cycle(run[1]))
+        return all(key in self.landed for key in [('ecmwf', *base_run), ('ecmwf-eps', *run), ('gfs-ens-bc', *run),
+                                                  ('cmc-ens', *base_run)])
+
+    def scan(self):
+        """
+        list the directory if it changed since the last scan
+        :return: sorted list of the (date, cycle) runs that every model has landed for since the last scan
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return []
+        self.mtime = mtime
+        suffix = f'.{self.degree_days}.csv'
+        oldest = (self.last_run[0], base_cycle(self.last_run[1]))
+        candidates = set()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.endswith(suffix) or name.count('.') != 4:
+                    continue
+                model, date, cycle = name.split('.')[:3]
+                run = (date, cycle)
+                if model not in MODELS or cycle not in self.cycles or run < oldest or (model, *run) in self.landed:
+                    continue
+                if entry.stat().st_size == 0:
+                    # still being written in place, writing to it won't touch the directory mtime so list it again
+                    self.mtime = None
+                    continue
+                self.landed[(model, *run)] = os.path.join(self.path, name)
+                # an ecmwf or cmc-ens run can complete the run six hours after it as well
+                candidates.update((date, other) for other in self.cycles if base_cycle(other) == cycle)
+                candidates.add(run)
+        return sorted(run for run in candidates if run > self.last_run and self.is_complete(run))
+
+    def predict_run(self, run):
+        """
+        align a complete run after the runs before it, build its feature row and predict it
+        :param run: (date, cycle) every model has landed for
+        :return: the record written to the predictions file, or None if the run has no feature row
+        """
+        start = time.perf_counter()
+        if run <= self.last_run:
+            return None
+        base_run = (run[0], base_cycle(run[1]))
+        files = {model: self.landed[(model, *model_run)]
+                 for model, model_run in zip(MODELS, [base_run, run, run, base_run])}
+        for model, model_files in zip(MODELS, self.sorted_files):
+            model_files.append(files[model])
+        self.last_run = run
+        # runs older than this one can no longer be aligned in order, the next ProcessRawData picks them up
+        self.landed = {key: file for key, file in self.landed.items() if key[1:] >= base_run}
+        if len(self.sorted_files[1]) < 3:
+            return None
+
+        master_df = build_master_df(*(model_files[-self.history:] for model_files in self.sorted_files),
+                                    cache=self.cache, cycles=self.cycles)
+        date = get_date(None, files['ecmwf-eps'])
+        if master_df.empty or master_df.index[-1] != date:
+            print(f'{run} is missing lead days, no prediction')
+            return None
+        features = master_df.iloc[[-1]].drop(columns=self.label_columns)
+        predictions = self.predictor.predict(features)
+        build_time = time.perf_counter() - start
+
+        record = {'run': '.'.join(run),
+                  'date': date.isoformat(),
+                  'predictions': {label: float(value) for label, value in predictions.iloc[0].items()},
+                  'build_seconds': build_time}
+        # the ctime also moves when a file is renamed into place, unlike its mtime
+        landed_at = max(os.stat(file).st_ctime for file in files.values())
+        with open(self.predictions_file, 'a') as f:
+            record['latency_seconds'] = time.time() - landed_at
+            f.write(json.dumps(record) + '\n')
+        return record
+
+    def poll(self):
+        """
+        predict every run that has completed since the last poll
+        :return: list of the records written
+        """
+        records = [self.predict_run(run) for run in self.scan()]
+        return [record for record in records if record is not None]
+
+    def run(self):
+        """ poll forever """
+        while True:
+            for record in self.poll():
+                print(f"{record['run']}: predicted in {record['latency_seconds']:.3f}s")
+            time.sleep(self.poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('degree_days', nargs='?', default='gw_hdd')
+    parser.add_argument('--path', default='RawData')
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--cycles', nargs='+', default=CYCLES)
+    parser.add_argument('--service', help='predict through the prediction service at this url instead of loading '
+                                          'the predictor, e.g. http://127.0.0.1:8765')
+    args = parser.parse_args()
+
+    if args.service:
+        from prediction_service import PredictionClient
+        predictor = PredictionClient(args.degree_days, args.service)
+    else:
+        from MultiLabelPredictor import MultilabelPredictor
+        # every label model loaded and persisted up front, a new run only costs compute
+        predictor = MultilabelPredictor.load(f'models/{args.degree_days}', persist=True).preload()
+    watcher = RunWatcher(predictor, args.path, args.degree_days,
+                         poll_interval=args.poll_interval, cycles=args.cycles)
+    print(f'watching {args.path} for {args.degree_days} runs after {".".join(watcher.last_run)}')
+    watcher.run()